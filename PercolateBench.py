@@ -0,0 +1,242 @@
+#!/usr/bin/python
+
+# PercolateBench.py
+#
+# Scaling benchmark for PercolateTest2.
+#
+# Generates synthetic rolodex files in all three input layouts, salted with the
+# same kinds of bad records found in data.in (bad zips, overlong phones, stray
+# floats, unknown colors), then times each stage of PercolateTest2 over them.
+# Every size runs in its own child process so peak RSS is per size, and the
+# results are written as JSON so runs can be compared.
+#
+# usage: PercolateBench.py [--sizes 4,5,6] [--reject-rate 0.25] [--engine scalar|numpy]
+#                          [--output bench_results.json] [--keep]
+#     --sizes are powers of ten, eg 4,5,6,7,8 runs 10^4 through 10^8 lines
+# usage: PercolateBench.py --startup [--count 20] [--budget <ms>] [--output bench_results.json]
+#     cold start: wall time from exec to the first processed record of a small file, and of -h.
+#     with --budget, exits 1 when the median exec to first record is over that many ms
+
+import os
+import sys
+import json
+import time
+import random
+import tempfile
+import platform
+import subprocess
+
+import PercolateTest2
+
+names_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "census-derived-all-first.txt")
+
+colors = ["pink", "blue", "aqua marine", "yellow", "green", "red", "gray", "aquamarine"]
+unknown_colors = ["chartreuse", "mauve", "puce"]
+
+
+def LoadNames():
+    """ reads the census first names, title cased """
+    with open(names_file, 'r') as input_file:
+        return [line.strip().title() for line in input_file if line.strip()]
+
+
+def Digits(rng, count):
+    return "".join(rng.choice("0123456789") for i in range(count))
+
+
+def GoodLine(rng, names):
+    """ one valid record in a randomly chosen layout """
+    first = rng.choice(names)
+    last = rng.choice(names)
+    color = rng.choice(colors)
+    zip_code = Digits(rng, 5)
+    area, exchange, number = Digits(rng, 3), Digits(rng, 3), Digits(rng, 4)
+    layout = rng.randint(0, 2)
+    if layout == 0:
+        return "%s, %s, (%s)-%s-%s, %s, %s" % (last, first, area, exchange, number, color, zip_code)
+    if layout == 1:
+        return "%s %s, %s, %s, %s %s %s" % (first, last, color, zip_code, area, exchange, number)
+    return "%s, %s, %s, %s %s %s, %s" % (first, last, zip_code, area, exchange, number, color)
+
+
+def RejectLine(rng, names):
+    """ one invalid record, modelled on the rejects in data.in """
+    kind = rng.randint(0, 3)
+    if kind == 0:
+        return repr(rng.random())
+    if kind == 1:
+        return "%s, %s, 123123121, %s %s %s, %s" % (rng.choice(names), rng.choice(names),
+                                                    Digits(rng, 3), Digits(rng, 3), Digits(rng, 4),
+                                                    rng.choice(colors))
+    if kind == 2:
+        return "%s, %s, (555)-11111-11111111, %s, %s" % (rng.choice(names), rng.choice(names),
+                                                         rng.choice(colors), Digits(rng, 5))
+    return "%s %s, %s, %s, %s %s %s" % (rng.choice(names), rng.choice(names), rng.choice(unknown_colors),
+                                        Digits(rng, 5), Digits(rng, 3), Digits(rng, 3), Digits(rng, 4))
+
+
+def GenerateRolodex(file_name, number_of_lines, reject_rate=0.25, seed=2015):
+    """ writes a synthetic input file
+    :param file_name: file to write
+    :param number_of_lines: how many lines to write
+    :param reject_rate: fraction of lines which should be rejected
+    :param seed: random seed, so the same size always gives the same file
+    """
+    rng = random.Random(seed)
+    names = LoadNames()
+    with open(file_name, 'w') as output_file:
+        lines = []
+        for i in xrange(number_of_lines):
+            if rng.random() < reject_rate:
+                lines.append(RejectLine(rng, names))
+            else:
+                lines.append(GoodLine(rng, names))
+            if len(lines) == 10000:
+                output_file.write("\n".join(lines) + "\n")
+                lines = []
+        if lines:
+            output_file.write("\n".join(lines) + "\n")
+
+
+def PeakRSS():
+    """ peak resident set size of this process in KB, None where unavailable """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # darwin reports bytes, linux KB
+    return peak / 1024 if sys.platform == "darwin" else peak
+
+
+def TimeStages(data_file_name, engine="scalar"):
+    """ runs each stage of PercolateTest2 once over a file. runs in the child process
+    :param data_file_name: input file, result.out is written to the current directory
+    :param engine: PercolateTest2 engine to use
+    :returns : dict of measurements
+    """
+    PercolateTest2.engine = engine
+    PercolateTest2.data_file_name = data_file_name
+    PercolateTest2.console_io = False
+    PercolateTest2.verbose_mode = False
+    stages = {}
+
+    start = time.time()
+    number_of_lines = 0
+    for raw_line in PercolateTest2.FetchNext():
+        number_of_lines += 1
+    stages["FetchNext"] = time.time() - start
+
+    start = time.time()
+    interim_list_of_records, list_of_errors, list_of_error_details = PercolateTest2.BuildRecordList()
+    stages["BuildRecordList"] = time.time() - start
+    number_of_entries = len(interim_list_of_records)
+
+    start = time.time()
+    data = PercolateTest2.SortAndFinalize(interim_list_of_records, list_of_errors, list_of_error_details)
+    stages["SortAndFinalize"] = time.time() - start
+
+    start = time.time()
+    PercolateTest2.OutputResults(data)
+    stages["OutputResults"] = time.time() - start
+
+    # FetchNext is measured on its own, BuildRecordList reads the input again
+    total = stages["BuildRecordList"] + stages["SortAndFinalize"] + stages["OutputResults"]
+    return {"engine": engine, "lines": number_of_lines, "entries": number_of_entries, "errors": len(list_of_errors),
+            "seconds": total, "records_per_sec": number_of_lines / total if total else None,
+            "peak_rss_kb": PeakRSS(), "stages": stages}
+
+
+def RunOne(data_file_name, work_dir, engine):
+    """ times one file in a fresh interpreter so peak RSS belongs to this size alone """
+    child = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--child", os.path.abspath(data_file_name),
+                              engine], cwd=work_dir, stdout=subprocess.PIPE)
+    output = child.communicate()[0]
+    if child.returncode != 0:
+        raise RuntimeError("benchmark child failed on %s" % data_file_name)
+    return json.loads(output.splitlines()[-1])
+
+
+def TimeStartup(data_file_name, work_dir, count):
+    """ times cold starts of PercolateTest2, each in a fresh interpreter
+    :param data_file_name: small input file
+    :param work_dir: where result.out goes
+    :param count: runs of each kind, the median is reported
+    :returns : dict of measurements, in seconds
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "PercolateTest2.py")
+    first_record = []
+    usage = []
+    with open(os.devnull, 'r') as devnull:
+        for i in range(count):
+            started = time.time()
+            child = subprocess.Popen([sys.executable, script, data_file_name, "--stats"], cwd=work_dir,
+                                     stdin=devnull, stdout=subprocess.PIPE)
+            output = child.communicate()[0]
+            # ReportStats prints "first record after <s>s (at <time>)"
+            line = [line for line in output.splitlines() if "first record after" in line][0]
+            first_record.append(float(line.split("(at ")[1].rstrip(")")) - started)
+            started = time.time()
+            subprocess.Popen([sys.executable, script, "-h"], cwd=work_dir, stdin=devnull,
+                             stdout=subprocess.PIPE).communicate()
+            usage.append(time.time() - started)
+    return {"runs": count, "exec_to_first_record": sorted(first_record)[count / 2],
+            "usage": sorted(usage)[count / 2]}
+
+
+def bench_main():
+    arglist = sys.argv[1:]
+    if "--child" in arglist:
+        print json.dumps(TimeStages(*arglist[arglist.index("--child") + 1:]))
+        return
+    startup = "--startup" in arglist
+    count = int(PercolateTest2.PopOption(arglist, "--count") or 20)
+    budget = PercolateTest2.PopOption(arglist, "--budget")
+    over_budget = False
+
+    sizes = PercolateTest2.PopOption(arglist, "--sizes") or "4,5,6"
+    reject_rate = float(PercolateTest2.PopOption(arglist, "--reject-rate") or 0.25)
+    output_file_name = PercolateTest2.PopOption(arglist, "--output") or "bench_results.json"
+    engine = PercolateTest2.PopOption(arglist, "--engine") or "scalar"
+    keep = "--keep" in arglist
+
+    work_dir = tempfile.mkdtemp(prefix="percolatebench")
+    results = {"timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+               "platform": platform.platform(), "reject_rate": reject_rate, "engine": engine, "runs": []}
+    try:
+        if startup:
+            data_file_name = os.path.join(work_dir, "rolodex_startup.in")
+            GenerateRolodex(data_file_name, 100, reject_rate)
+            results["startup"] = TimeStartup(data_file_name, work_dir, count)
+            print "exec to first record %.1fms  -h %.1fms  (median of %d)" % (
+                results["startup"]["exec_to_first_record"] * 1000, results["startup"]["usage"] * 1000, count)
+            if budget:
+                results["startup"]["budget"] = float(budget) / 1000
+                over_budget = results["startup"]["exec_to_first_record"] > results["startup"]["budget"]
+                print "%s the %sms budget" % ("OVER" if over_budget else "within", budget)
+            sizes = ""
+        for exponent in [int(size) for size in sizes.split(",") if size]:
+            data_file_name = os.path.join(work_dir, "rolodex_1e%d.in" % exponent)
+            GenerateRolodex(data_file_name, 10 ** exponent, reject_rate)
+            run = RunOne(data_file_name, work_dir, engine)
+            results["runs"].append(run)
+            print "%9d lines  %9.0f records/sec  peak %8s KB  %s" % (
+                run["lines"], run["records_per_sec"], run["peak_rss_kb"],
+                "  ".join("%s %.3fs" % (stage, run["stages"][stage]) for stage in sorted(run["stages"])))
+            if not keep:
+                os.remove(data_file_name)
+    finally:
+        if not keep:
+            for file_name in os.listdir(work_dir):
+                os.remove(os.path.join(work_dir, file_name))
+            os.rmdir(work_dir)
+
+    with open(output_file_name, 'w') as output_file:
+        json.dump(results, output_file, sort_keys=True, indent=2)
+    print "results written to", output_file_name
+    if over_budget:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    bench_main()
@@ -0,0 +1,205 @@
+#!/usr/bin/python
+
+# PercolateService.py
+#
+# Keeps PercolateTest2 warm in a long running process and runs jobs sent to it over a
+# local Unix socket, so each job skips interpreter startup, imports & regex compilation.
+# Every job runs in its own fork of the warm server, so jobs run concurrently and the
+# module level settings of one job can't leak into another.
+#
+# usage: PercolateService.py serve [--socket <path>]
+#     runs the server until interrupted or sent SIGTERM
+# usage: PercolateService.py run [--socket <path>] [--stdin] [--inline] <PercolateTest2 arguments>
+#     runs one job. --stdin sends this process's stdin as the input file, --inline prints
+#     the result instead of only its path (gzipped output is decompressed, --format sqlite
+#     output isn't text and is left out). exits with the job's return code
+# usage: PercolateService.py bench [--socket <path>] [--count 20] <input file>
+#     compares job latency through a running server against cold command line runs
+#
+# protocol: the client sends one line of JSON {"args": [...], "cwd": ..., "stdin": bool, "inline": bool},
+# then the input data if stdin is true, then shuts down its side. the server answers with one
+# JSON object {"returncode", "stdout", "stderr", "output"[, "result"]} and closes the connection.
+
+import os
+import sys
+import gzip
+import json
+import time
+import signal
+import socket
+import tempfile
+import traceback
+import subprocess
+import SocketServer
+import cStringIO
+
+import PercolateTest2
+
+default_socket = os.path.join(tempfile.gettempdir(), "percolate.sock")
+
+
+class JobHandler(SocketServer.StreamRequestHandler):
+    """ runs one job, in a child process forked from the warm server """
+
+    def handle(self):
+        input_file_name = None
+        try:
+            request = json.loads(self.rfile.readline())
+            args = list(request["args"])
+            if request.get("stdin"):
+                handle, input_file_name = tempfile.mkstemp(prefix="percolatejob", suffix=".in")
+                with os.fdopen(handle, 'wb') as input_file:
+                    while True:
+                        data = self.rfile.read(PercolateTest2.block_size)
+                        if not data:
+                            break
+                        input_file.write(data)
+                args.append(input_file_name)
+            reply = json.dumps(RunJob(args, request.get("cwd") or os.getcwd(), request.get("inline")))
+        except Exception:
+            # the client is always answered, otherwise all it sees is the connection closing
+            reply = json.dumps({"returncode": 5, "stdout": "", "stderr": traceback.format_exc(), "output": None})
+        finally:
+            if input_file_name:
+                os.remove(input_file_name)
+        self.wfile.write(reply)
+
+
+class ForkingUnixServer(SocketServer.ForkingMixIn, SocketServer.UnixStreamServer):
+    pass
+
+
+def RunJob(args, cwd, inline=False):
+    """ runs percolate_main as if from the command line
+    :param args: PercolateTest2 arguments, without the program name
+    :param cwd: directory to run in, relative file names and the output are resolved there
+    :param inline: include the contents of the output in the reply
+    :returns : reply dict
+    """
+    os.chdir(cwd)
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout, sys.stderr = cStringIO.StringIO(), cStringIO.StringIO()
+    sys.argv = ["PercolateTest2.py"] + args
+    returncode = 0
+    try:
+        try:
+            PercolateTest2.percolate_main()
+        except SystemExit as e:
+            returncode = e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+        except Exception:
+            traceback.print_exc()
+            returncode = 5
+        reply = {"returncode": returncode, "stdout": sys.stdout.getvalue(), "stderr": sys.stderr.getvalue(),
+                 "output": os.path.abspath(PercolateTest2.output_file_name)}
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    if inline and os.path.isfile(reply["output"]):
+        if PercolateTest2.output_format == "sqlite":
+            reply["stderr"] += "--inline: sqlite output isn't text, it is in %s\n" % reply["output"]
+        else:
+            opener = gzip.open if reply["output"].endswith(".gz") else open
+            with opener(reply["output"], 'rb') as output_file:
+                reply["result"] = output_file.read()
+    return reply
+
+
+def Terminate(signal_number, frame):
+    """ SIGTERM stops the server the same way ^C does, so the socket is removed """
+    raise KeyboardInterrupt
+
+
+def Serve(socket_path):
+    """ runs the server until interrupted """
+    if os.path.exists(socket_path):
+        os.remove(socket_path)
+    server = ForkingUnixServer(socket_path, JobHandler)
+    signal.signal(signal.SIGTERM, Terminate)
+    print "PercolateService listening on", socket_path
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.remove(socket_path)
+
+
+def SendJob(socket_path, args, input_stream=None, inline=False, cwd=None):
+    """ sends one job to the server
+    :param socket_path: the server's socket
+    :param args: PercolateTest2 arguments, without the program name
+    :param input_stream: file to send as the job's input, None to use a file named in args
+    :param inline: ask for the contents of the output in the reply
+    :param cwd: directory the job runs in, defaults to the current one
+    :returns : reply dict
+    """
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(socket_path)
+    try:
+        request = {"args": args, "cwd": cwd or os.getcwd(), "stdin": input_stream is not None, "inline": inline}
+        connection.sendall(json.dumps(request) + "\n")
+        if input_stream is not None:
+            while True:
+                data = os.read(input_stream.fileno(), PercolateTest2.block_size)
+                if not data:
+                    break
+                connection.sendall(data)
+        connection.shutdown(socket.SHUT_WR)
+        chunks = []
+        while True:
+            data = connection.recv(PercolateTest2.block_size)
+            if not data:
+                break
+            chunks.append(data)
+    finally:
+        connection.close()
+    return json.loads("".join(chunks))
+
+
+def Bench(socket_path, data_file_name, count):
+    """ prints median & mean latency of cold command line runs vs jobs through the server """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "PercolateTest2.py")
+    timings = {"cold": [], "warm": []}
+    with open(os.devnull, 'w') as devnull:
+        for i in range(count):
+            start = time.time()
+            subprocess.call([sys.executable, script, data_file_name], stdout=devnull, stderr=devnull)
+            timings["cold"].append(time.time() - start)
+            start = time.time()
+            SendJob(socket_path, [data_file_name])
+            timings["warm"].append(time.time() - start)
+    for kind in ("cold", "warm"):
+        ordered = sorted(timings[kind])
+        print "%s  median %.1fms  mean %.1fms  over %d runs" % (
+            kind, ordered[len(ordered) / 2] * 1000, sum(ordered) / len(ordered) * 1000, len(ordered))
+
+
+def service_main():
+    arglist = sys.argv[1:]
+    if not arglist or arglist[0] not in ("serve", "run", "bench"):
+        sys.stderr.write("usage: PercolateService.py serve|run|bench [options], see the top of this file\n")
+        sys.exit(1)
+    command = arglist.pop(0)
+    socket_path = PercolateTest2.PopOption(arglist, "--socket") or default_socket
+
+    if command == "serve":
+        Serve(socket_path)
+    elif command == "bench":
+        count = int(PercolateTest2.PopOption(arglist, "--count") or 20)
+        Bench(socket_path, arglist[0], count)
+    else:
+        use_stdin = "--stdin" in arglist
+        inline = "--inline" in arglist
+        args = [arg for arg in arglist if arg not in ("--stdin", "--inline")]
+        reply = SendJob(socket_path, args, sys.stdin if use_stdin else None, inline)
+        sys.stdout.write(reply["stdout"])
+        sys.stderr.write(reply["stderr"])
+        if inline and "result" in reply:
+            sys.stdout.write(reply["result"] + "\n")
+        elif reply["returncode"] == 0:
+            print "output:", reply["output"]
+        sys.exit(reply["returncode"])
+
+
+if __name__ == '__main__':
+    service_main()
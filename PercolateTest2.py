@@ -33,13 +33,22 @@
 # http://users.ece.utexas.edu/~perry/work/papers/joop.pdf
 
 
+# only what every run needs is imported here. modules needed by one mode (json for output,
+# hashlib for -t, multiprocessing for -j, cPickle & tempfile for spilled runs, traceback for
+# errors) are imported by the functions which use them, so -h & small files start quickly
 import os.path
 import sys
 import re
-import json
-import filecmp
-import traceback
 import time
+import mmap
+import cStringIO
+import struct
+import errno
+import collections
+import zlib
+
+# only needed for --engine numpy, see LoadNumpy
+numpy = None
 
 test_mode = False
 verbose_mode = False
@@ -48,9 +57,216 @@ console_io = False
 data_file_name = ""
 canonical_output_file = ""
 
-valid_colors = "pink, blue, aqua marine, yellow, green, red, gray, grey, aquamarine, orange, purple, brown, " + \
-               "white, black, violet, silver, gold, teal, maroon, rust, emerald, sapphire, peach cobalt, magenta" + \
-               "cerise, cerulean"
+# where the result document goes. with --per-file, the directory each input's result goes in
+output_file_name = "result.out"
+
+# batch mode: every input file, when there is more than one (or --per-file), processed by a pool
+# of workers into one merged result, or with --per-file, into one result per input
+data_file_names = []
+per_file_mode = False
+
+# output backend (--format): "json" writes the result document, "sqlite" loads the entries
+# & errors into a SQLite database, sqlite_batch rows per executemany & transaction
+output_format = "json"
+sqlite_batch = 500000
+
+# sidecar lookup index (--index): written to <output>.idx, sampling the key & byte offset
+# of every index_block'th entry. --lookup <name> searches it instead of processing input
+index_mode = False
+index_block = 64
+lookup_name = None
+lookup_prefix = False
+
+# bounded memory mode: None means sort everything in memory
+max_memory = None
+# rough cost in bytes of one interim record (tuple + dict + 5 strings)
+record_cost_estimate = 1024
+# temp files holding sorted runs spilled by BuildRecordList
+sort_runs = []
+
+# paged output (--offset, --limit): entries before output_offset are skipped and at most
+# output_limit are written. None means no limit
+output_offset = 0
+output_limit = None
+
+# number of worker processes for BuildRecordList, and the most bytes of input handed to one at a time
+jobs = 1
+chunk_size = 8 * 1024 * 1024
+
+# bytes handed out per block by FetchBlocks
+block_size = 1024 * 1024
+
+# lines are checked as bytes. only the fields of accepted lines are decoded, and rejected
+# lines when they are written out, using input_encoding (--encoding)
+input_encoding = "utf-8"
+
+# compressed input is recognized by its first bytes, and decompressed as it's read
+compression_magic = [("gzip", "\x1f\x8b"), ("bzip2", "BZh"), ("xz", "\xfd7zXZ\x00")]
+# gzip level for output files named *.gz
+output_compress_level = 6
+
+# checkpoint mode: state directory, whether to pick up from it, and how many records between checkpoints
+checkpoint_dir = None
+resume_mode = False
+checkpoint_interval = 1000000
+
+# duplicate detection: collapse repeats of the same person, and whether to report them as errors
+dedup_mode = False
+dedup_report = False
+
+# first name index (--name-order): census name list, its compiled form, and the open index
+name_source_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), "census-derived-all-first.txt")
+name_index_file = os.path.splitext(name_source_file)[0] + ".idx"
+name_index = None
+
+# "scalar" checks one line at a time, "numpy" checks blocks of lines as arrays
+engine = "scalar"
+
+# rejects: optional NDJSON file every reject is written to as it happens, and a cap
+# on how many error details are kept in memory for the result document
+reject_log_file_name = None
+max_error_details = None
+
+# test mode check OutputResults writes through, see OpenCanonicalCheck
+canonical_check = None
+
+# streaming mode (--stream): every record is written as a line of JSON as soon as it is read
+stream_mode = False
+
+# instrumentation (--stats). None when disabled, otherwise the Bag made by StartStats
+stats = None
+# callables handed the stats Bag at the end of a run, for programmatic use
+stats_hooks = []
+
+# one entry per color: the canonical spelling first, then any aliases
+default_colors = [["pink"], ["blue"], ["aquamarine", "aqua marine"], ["yellow"], ["green"], ["red"],
+                  ["gray", "grey"], ["orange"], ["purple"], ["brown"], ["white"], ["black"], ["violet"],
+                  ["silver"], ["gold"], ["teal"], ["maroon"], ["rust"], ["emerald"], ["sapphire"], ["peach"],
+                  ["cobalt"], ["magenta"], ["cerise"], ["cerulean"]]
+
+# optional color list file, and whether entries get the canonical spelling
+color_file_name = None
+canonical_colors = False
+
+
+def LoadNumpy():
+    """ imports numpy on first use
+    :returns : True if numpy is available
+    """
+    global numpy
+    if numpy is None:
+        try:
+            import numpy
+        except ImportError:
+            return False
+    return True
+
+
+def BuildColorIndex(color_lists):
+    """ builds the color vocabulary
+    :param color_lists: iterable of lists of spellings, canonical spelling first
+    :returns : dict of every accepted spelling -> canonical spelling
+    """
+    index = {}
+    for spellings in color_lists:
+        for spelling in spellings:
+            index[unicode(spelling)] = unicode(spellings[0])
+    return index
+
+
+def LoadColors(file_name):
+    """ reads a color list file. one color per line, aliases follow the
+        canonical spelling separated by commas, eg "gray, grey". blank lines
+        and lines starting with # are ignored
+    :param file_name: the color list file
+    :returns : the color vocabulary, see BuildColorIndex
+    """
+    color_lists = []
+    with open(file_name, 'r') as color_file:
+        for line in color_file:
+            line = line.strip()
+            if line and not line.startswith("#"):
+                color_lists.append([spelling.strip() for spelling in line.split(",") if spelling.strip()])
+    return BuildColorIndex(color_lists)
+
+
+valid_colors = BuildColorIndex(default_colors)
+
+
+class NameIndex(object):
+    """ read only hash set of names, memory mapped from a file built by BuildNameIndex.
+        the file is a header followed by an open addressing table of fixed width,
+        zero padded slots, so a lookup is a crc32 and usually one slot compare.
+    """
+    header = struct.Struct("<4sII")
+    magic = "PNX1"
+
+    def __init__(self, file_name):
+        with open(file_name, 'rb') as index_file:
+            self.mapped = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.slot_width, self.number_of_slots = self.header.unpack_from(self.mapped)
+        if magic != self.magic:
+            raise ValueError("not a name index: " + file_name)
+        self.mask = self.number_of_slots - 1
+        self.empty = "\0" * self.slot_width
+
+    def __contains__(self, name):
+        name = name.upper().encode("ascii", "replace")
+        # an empty name pads out to the same bytes as an empty slot
+        if not name or len(name) >= self.slot_width:
+            return False
+        padded = name.ljust(self.slot_width, "\0")
+        slot = zlib.crc32(name) & self.mask
+        while True:
+            position = self.header.size + slot * self.slot_width
+            stored = self.mapped[position:position + self.slot_width]
+            if stored == padded:
+                return True
+            if stored == self.empty:
+                return False
+            slot = (slot + 1) & self.mask
+
+
+def BuildNameIndex(source_file_name, index_file_name):
+    """ compiles a name list, one name per line, into a NameIndex file
+    :param source_file_name: the name list
+    :param index_file_name: the index file to write
+    """
+    with open(source_file_name, 'r') as source_file:
+        names = set(line.strip().upper() for line in source_file if line.strip())
+    slot_width = max(len(name) for name in names) + 1
+    number_of_slots = 1
+    # keep the table at most half full so probe chains stay short
+    while number_of_slots < len(names) * 2:
+        number_of_slots *= 2
+    slots = [None] * number_of_slots
+    for name in names:
+        slot = zlib.crc32(name) & (number_of_slots - 1)
+        while slots[slot] is not None:
+            slot = (slot + 1) & (number_of_slots - 1)
+        slots[slot] = name
+    temp_file_name = index_file_name + ".tmp"
+    with open(temp_file_name, 'wb') as index_file:
+        index_file.write(NameIndex.header.pack(NameIndex.magic, slot_width, number_of_slots))
+        for name in slots:
+            index_file.write((name or "").ljust(slot_width, "\0"))
+    if os.name == 'nt' and os.path.exists(index_file_name):
+        os.remove(index_file_name)
+    os.rename(temp_file_name, index_file_name)
+
+
+def OpenNameIndex():
+    """ maps the first name index, compiling it first if it is missing or older than the name list
+    :var name_source_file (global): census name list
+    :var name_index_file (global): compiled index
+    :returns : the NameIndex
+    """
+    if not os.path.isfile(name_source_file):
+        raise EFileNotFound(filename="name list: " + name_source_file)
+    if not os.path.isfile(name_index_file) or \
+            os.path.getmtime(name_index_file) < os.path.getmtime(name_source_file):
+        BuildNameIndex(name_source_file, name_index_file)
+    return NameIndex(name_index_file)
 
 
 class Bag(dict):
@@ -58,6 +274,9 @@ class Bag(dict):
         the data elements appear as object properties.
         eg. foo.bar = 12 rather than foo["bar"] = 12
     """
+    # the elements live in the dict itself, so no per object __dict__ on top of it
+    __slots__ = ()
+
     def __getattr__(self, name):
         """ returns specified attribute """
         return self[name]
@@ -67,6 +286,100 @@ class Bag(dict):
         self[name] = value
 
 
+class Record(collections.namedtuple("Record", "key color first last phone zip")):
+    """ one accepted entry. a plain tuple underneath, so there is no dict per record, and
+        records sort by "last, first" then by the fields in sorted key order, which is
+        exactly how the (key, dict) pairs used before sorted
+    """
+    __slots__ = ()
+
+    def AsDict(self):
+        """ the entry as it is written out """
+        return {u"color": self.color, u"first": self.first, u"last": self.last, u"phone": self.phone,
+                u"zip": self.zip}
+
+
+class ErrorDetail(collections.namedtuple("ErrorDetail", "record error line")):
+    """ one rejected line """
+    __slots__ = ()
+
+    def AsDict(self):
+        """ the error detail as it is written out """
+        return {"record": self.record, "error": self.error, "line": DecodeText(self.line)}
+
+
+def DecodeText(text):
+    """ input bytes as text, for writing out. bytes which aren't valid in input_encoding
+        become U+FFFD rather than stopping the run
+    """
+    return text.decode(input_encoding, "replace") if isinstance(text, str) else text
+
+
+def StartStats():
+    """ turns instrumentation on. stages, rule counts & rule timings are collected into the stats Bag
+    :returns : the new stats Bag
+    """
+    global stats
+    stats = Bag(started=time.time(), lines=0, stages={}, rule_counts={}, rule_seconds={})
+    return stats
+
+
+def RecordStage(name, started):
+    """ records the wall time of one stage, if instrumentation is on
+    :param name: stage name, eg "BuildRecordList"
+    :param started: time.time() when the stage began
+    """
+    if stats is not None:
+        stats.stages[name] = stats.stages.get(name, 0.0) + time.time() - started
+
+
+def RecordRule(error, seconds=0.0):
+    """ counts one line against the rule which decided it
+    :param error: error returned by ProcessLine, None for accepted lines
+    :param seconds: time spent on the line
+    """
+    rule = error.split(":")[0] if error else "accepted"
+    if not stats.lines:
+        stats.first_record = time.time()
+    stats.lines += 1
+    stats.rule_counts[rule] = stats.rule_counts.get(rule, 0) + 1
+    stats.rule_seconds[rule] = stats.rule_seconds.get(rule, 0.0) + seconds
+
+
+def MergeStats(file_stats):
+    """ adds the counts a batch worker collected for one file to stats
+    :param file_stats: (lines, first_record, rule_counts, rule_seconds) from ProcessFile, None without --stats
+    """
+    if file_stats is None or stats is None:
+        return
+    lines, first_record, rule_counts, rule_seconds = file_stats
+    if lines and (not stats.lines or first_record < stats.first_record):
+        stats.first_record = first_record
+    stats.lines += lines
+    for rule in rule_counts:
+        stats.rule_counts[rule] = stats.rule_counts.get(rule, 0) + rule_counts[rule]
+        stats.rule_seconds[rule] = stats.rule_seconds.get(rule, 0.0) + rule_seconds[rule]
+
+
+def ReportStats():
+    """ prints the collected stats and passes them to any stats_hooks """
+    if stats is None:
+        return
+    stats.seconds = time.time() - stats.started
+    stats.lines_per_sec = stats.lines / stats.seconds if stats.seconds else 0.0
+    for hook in stats_hooks:
+        hook(stats)
+    print "stats:"
+    for name in sorted(stats.stages, key=stats.stages.get, reverse=True):
+        print "  stage %-16s %9.3fs" % (name, stats.stages[name])
+    for rule in sorted(stats.rule_counts):
+        print "  rule  %-16s %9d lines %9.3fs" % (rule, stats.rule_counts[rule], stats.rule_seconds[rule])
+    print "  %d lines in %.3fs, %.0f lines/sec" % (stats.lines, stats.seconds, stats.lines_per_sec)
+    if stats.lines:
+        # the absolute time is for measuring start up from outside, see PercolateBench.py --startup
+        print "  first record after %.3fs (at %.6f)" % (stats.first_record - stats.started, stats.first_record)
+
+
 class ERootException(Exception):
     def __init__(self, passed_number, passed_message, **kwargs):
         self.message = passed_message
@@ -94,6 +407,27 @@ class EInvalidArguments(ERootException):
         self.number = 1
 
 
+class ECanonicalMismatch(ERootException):
+    def __init__(self, **kwargs):
+        self.d = Bag(kwargs)
+        self.number = 4
+        self.Describe()
+
+    def Locate(self, key, index):
+        """ adds which record was being written when the output diverged """
+        self.d.key = key
+        self.d.index = index
+        self.Describe()
+
+    def Describe(self):
+        if "key" in self.d:
+            where = "%s[%d] (byte %d)" % (self.d.key, self.d.index, self.d.offset)
+        else:
+            where = "byte %d" % self.d.offset
+        self.message = "error - canonical test output failed at %s\n  expected: %s\n  actual:   %s\n" % (
+            where, self.d.expected, self.d.actual)
+
+
 class ENone(ERootException):
     def __init__(self):
         self.message = "OK"
@@ -105,14 +439,51 @@ def PrintUsage():
 
     print "PercolateTest.py"
     print "Processes a rolodex input file into JSON.\n"
-    print "usage: PercolateTest.py <filename> [-v]"
+    print "usage: PercolateTest.py <filename> [<filename> ...] [-v]"
     print "     filename = input file to parse. Output written to result.out"
+    print "     a directory stands for every file in it, and a quoted glob for every file it matches."
+    print "     several inputs are processed at once by a pool of workers, and merged into one sorted"
+    print "     result whose errors are '<filename>:<record>'"
     print "usage: PercolateTest.py -t <canonical input file prefix only>"
     print "     <canonical input file prefix only> eg 'canonical' uses canonical.in and canonical.out"
-    print "usage: PercolateTest.py -t <canonical in> <canonical out>\n"
+    print "usage: PercolateTest.py -t <canonical in> <canonical out>"
+    print "     <canonical out> may also be a .sha1 digest manifest of the expected output\n"
     print "-h usage"
     print "-t run in test mode (implies -v)"
     print "-v verbose output (normally off)"
+    print "-j <N> process the input file with N worker processes (with several inputs, N files at a time)"
+    print "--output <file> write the result to file instead of result.out. a name ending .gz is gzipped"
+    print "--encoding <name> input encoding (default utf-8). must be ascii compatible, eg latin-1 or cp1252"
+    print "(gzip, bzip2 & xz input files are recognized by content and decompressed as they're read,"
+    print "     -j is ignored for them. xz needs backports.lzma or the xz command)"
+    print "--format <json|sqlite> sqlite writes the entries & errors tables of a SQLite database"
+    print "     instead, to result.db unless --output is given (not with -t, --index or --per-file)"
+    print "--index also write <output>.idx, a sorted index of the entries, for --lookup"
+    print "usage: PercolateTest.py --lookup <'last, first'> [--prefix] [--output <file>]"
+    print "     prints the entries for one name from an indexed result, one line of JSON each,"
+    print "     or with --prefix every entry whose 'last, first' starts with the name, eg a last name"
+    print "--per-file with several inputs, write each one's result to <dir>/<input name>.result.out,"
+    print "     where --output names the directory (default the current one)"
+    print "     (several inputs can't be used with --checkpoint, --max-memory, --dedup or --reject-log)"
+    print "--max-memory <MB> keep roughly this much record data in memory, spilling sorted runs to temp files"
+    print "--limit <N> write only the first N entries, keeping no more than 2 * (offset + N) records in memory"
+    print "--offset <N> skip the first N entries (errors are always written in full)"
+    print "--colors <file> read the valid colors from file, one per line as 'canonical, alias, ...'"
+    print "--canonical-colors write each color's canonical spelling (eg grey -> gray)"
+    print "--checkpoint <dir> save progress to dir every --checkpoint-every <N> records (default 1000000)"
+    print "--resume continue from the last checkpoint in the --checkpoint dir"
+    print "     (checkpointing reads the input serially, -j is ignored)"
+    print "--dedup drop records repeating an earlier (last, first, phone, zip)"
+    print "--dedup-report same as --dedup, and report each dropped record as a 'duplicate: <record>' error"
+    print "     (not available with --checkpoint)"
+    print "--name-order swap first & last when only the last name is a known first name"
+    print "     (census-derived-all-first.txt, compiled to census-derived-all-first.idx on first use)"
+    print "--engine <scalar|numpy> numpy validates zip, phone & color a block of lines at a time (needs numpy)"
+    print "--reject-log <file> write every reject to file as it happens, one line of JSON each"
+    print "--max-error-details <N> keep only the first N error details in memory & in result.out"
+    print "--stream write each entry & each reject to stdout as one line of JSON as soon as it is read,"
+    print "     unsorted. reads stdin when no filename is given"
+    print "--stats report time per stage, lines & time per rule, and throughput"
     print "(note that data integrity checks are run on all input records whether in test mode or not)\n"
     print "returned errors:"
     print "0 - Completed OK"
@@ -125,6 +496,41 @@ def PrintUsage():
     raise ENone
 
 
+def PopOption(arglist, name):
+    """ removes an option and its value from the argument list
+    :param arglist: list of arguments from command line
+    :param name: option name, eg "--max-memory"
+    :returns : the option's value, or None if the option wasn't given
+    """
+    if name not in arglist:
+        return None
+    index = arglist.index(name)
+    if index + 1 >= len(arglist):
+        raise EInvalidArguments(bad_arguments=name + " requires a value")
+    value = arglist[index + 1]
+    del arglist[index:index + 2]
+    return value
+
+
+def PopIntOption(arglist, name, minimum=1):
+    """ removes an option and its value from the argument list. the value must be an integer
+    :param arglist: list of arguments from command line
+    :param name: option name, eg "-j"
+    :param minimum: smallest value allowed
+    :returns : the option's value as an int, or None if the option wasn't given
+    """
+    value = PopOption(arglist, name)
+    if value is None:
+        return None
+    try:
+        number = int(value)
+    except ValueError:
+        raise EInvalidArguments(bad_arguments=name + " " + value)
+    if number < minimum:
+        raise EInvalidArguments(bad_arguments=name + " " + value)
+    return number
+
+
 def ProcessArgs(arglist):
     """     reads arguments and sets flags and variables
     :param arglist: list of arguments from command line
@@ -135,9 +541,59 @@ def ProcessArgs(arglist):
     global verbose_mode
     global data_file_name
     global canonical_output_file
+    global max_memory
+    global output_offset
+    global output_limit
+    global jobs
+    global color_file_name
+    global canonical_colors
+    global valid_colors
+    global checkpoint_dir
+    global resume_mode
+    global checkpoint_interval
+    global stats
+    global dedup_mode
+    global dedup_report
+    global name_index
+    global engine
+    global stream_mode
+    global reject_log_file_name
+    global max_error_details
+    global output_file_name
+    global data_file_names
+    global per_file_mode
+    global output_format
+    global input_encoding
+    global index_mode
+    global lookup_name
+    global lookup_prefix
 
     data_file_name = None
+    data_file_names = []
+    per_file_mode = False
+    output_format = "json"
+    input_encoding = "utf-8"
+    index_mode = False
+    lookup_name = None
+    lookup_prefix = False
     canonical_output_file = None
+    max_memory = None
+    output_offset = 0
+    output_limit = None
+    jobs = 1
+    color_file_name = None
+    canonical_colors = False
+    checkpoint_dir = None
+    resume_mode = False
+    checkpoint_interval = 1000000
+    stats = None
+    dedup_mode = False
+    dedup_report = False
+    name_index = None
+    engine = "scalar"
+    stream_mode = False
+    reject_log_file_name = None
+    max_error_details = None
 
     verbose_mode = False
     test_mode = False
@@ -149,16 +605,127 @@ def ProcessArgs(arglist):
             PrintUsage()
         except ENone:
             pass
+        if "-h" in arglist:
+            # usage is all -h asks for, don't go on to read the console
+            sys.exit(0)
+        raise EInvalidArguments(bad_arguments="No input file specified")
+
+    if "--stats" in arglist:
+        arglist.remove("--stats")
+        StartStats()
+
+    if "--dedup-report" in arglist:
+        arglist.remove("--dedup-report")
+        dedup_mode = True
+        dedup_report = True
+    if "--dedup" in arglist:
+        arglist.remove("--dedup")
+        dedup_mode = True
+
+    if "--name-order" in arglist:
+        arglist.remove("--name-order")
+        name_index = OpenNameIndex()
+
+    engine = PopOption(arglist, "--engine") or engine
+    if engine not in ("scalar", "numpy"):
+        raise EInvalidArguments(bad_arguments="--engine " + engine)
+    if engine == "numpy" and not LoadNumpy():
+        raise EInvalidArguments(bad_arguments="--engine numpy requires numpy, which is not installed")
+
+    input_encoding = PopOption(arglist, "--encoding") or input_encoding
+    try:
+        # the rules look for commas, spaces & digits as bytes
+        ascii_compatible = "Ab, 1-2.\n".decode(input_encoding) == u"Ab, 1-2.\n"
+    except (LookupError, UnicodeError):
+        ascii_compatible = False
+    if not ascii_compatible:
+        raise EInvalidArguments(bad_arguments="--encoding " + input_encoding)
+
+    reject_log_file_name = PopOption(arglist, "--reject-log")
+    max_error_details = PopIntOption(arglist, "--max-error-details")
+
+    max_memory = PopIntOption(arglist, "--max-memory")
+    output_limit = PopIntOption(arglist, "--limit")
+    output_offset = PopIntOption(arglist, "--offset", 0) or 0
+    jobs = PopIntOption(arglist, "-j") or 1
+
+    if "--canonical-colors" in arglist:
+        arglist.remove("--canonical-colors")
+        canonical_colors = True
+    color_file_name = PopOption(arglist, "--colors")
+    if color_file_name is not None:
+        if not os.path.isfile(color_file_name):
+            raise EFileNotFound(filename="color file: " + color_file_name)
+        valid_colors = LoadColors(color_file_name)
+    else:
+        valid_colors = BuildColorIndex(default_colors)
+
+    checkpoint_dir = PopOption(arglist, "--checkpoint")
+    checkpoint_interval = PopIntOption(arglist, "--checkpoint-every") or checkpoint_interval
+    if "--resume" in arglist:
+        arglist.remove("--resume")
+        if checkpoint_dir is None:
+            raise EInvalidArguments(bad_arguments="--resume requires --checkpoint <dir>")
+        if not os.path.isfile(os.path.join(checkpoint_dir, "state.json")):
+            raise EFileNotFound(filename="checkpoint: " + os.path.join(checkpoint_dir, "state.json"))
+        resume_mode = True
+    if dedup_mode and checkpoint_dir is not None:
+        raise EInvalidArguments(bad_arguments="--dedup can't be combined with --checkpoint")
+
+    if "--stream" in arglist:
+        arglist.remove("--stream")
+        stream_mode = True
+
+    if "--per-file" in arglist:
+        arglist.remove("--per-file")
+        per_file_mode = True
+    output_format = PopOption(arglist, "--format") or output_format
+    if output_format not in ("json", "sqlite"):
+        raise EInvalidArguments(bad_arguments="--format " + output_format)
+    default_output = "result.db" if output_format == "sqlite" else "result.out"
+    output_file_name = PopOption(arglist, "--output") or ("." if per_file_mode else default_output)
+    if "--index" in arglist:
+        arglist.remove("--index")
+        index_mode = True
+    if output_format == "sqlite" and ("-t" in arglist or index_mode or per_file_mode):
+        raise EInvalidArguments(bad_arguments="--format sqlite can't be used with -t, --index or --per-file")
+
+    lookup_name = PopOption(arglist, "--lookup")
+    if lookup_name is not None:
+        if "--prefix" in arglist:
+            arglist.remove("--prefix")
+            lookup_prefix = True
+        if not os.path.isfile(output_file_name + ".idx"):
+            raise EFileNotFound(filename="index: " + output_file_name + ".idx")
         raise ENone
-    elif len(arglist) == 0:
-        PrintUsage()
-        raise EInvalidArguments(message="No arguments passed")
+
+    if len(arglist) == 0 and not stream_mode:
+        # only options were given. the console is read with -t or --stream, never by default
+        try:
+            PrintUsage()
+        except ENone:
+            pass
+        raise EInvalidArguments(bad_arguments="No input file specified")
+    elif stream_mode:
+        if "-t" in arglist or checkpoint_dir is not None or max_memory or dedup_mode or output_limit or output_offset:
+            raise EInvalidArguments(
+                bad_arguments="--stream can't be used with -t, --checkpoint, --max-memory, --dedup, --limit or --offset")
+        if "-v" in arglist:
+            arglist.remove("-v")  # every reject is written anyway
+        if len(arglist) == 0:
+            console_io = True
+        else:
+            data_file_name = arglist[0]
+            if not os.path.isfile(data_file_name):
+                raise EFileNotFound(filename="input file: " + data_file_name)
     elif "-t" in arglist:
         arglist.remove("-t")  # we know we're in test mode
         if "-v" in arglist:
             arglist.remove("-v")  # verbose will be true anyway
         if len(arglist) == 0:
             console_io = True
+            if checkpoint_dir is not None:
+                raise EInvalidArguments(bad_arguments="--checkpoint can't be used with console input")
         if len(arglist) == 1:
             data_file_name = arglist[0] + ".in"  # test data
             canonical_output_file = arglist[0] + ".out"  # test data
@@ -177,30 +744,259 @@ def ProcessArgs(arglist):
             verbose_mode = True
             arglist.remove("-v")
         if len(arglist) == 0:
-            raise EInvalidArguments(message="No filename passed")
-        data_file_name = arglist[0]
-        # validate file
-        if not os.path.isfile(data_file_name):
-            raise EFileNotFound(filename="input file: " + data_file_name)
+            raise EInvalidArguments(bad_arguments="No input file specified")
+        # validate files
+        inputs = ExpandInputs(arglist)
+        data_file_name = inputs[0]
+        if len(inputs) > 1 or per_file_mode:
+            if checkpoint_dir is not None or max_memory or dedup_mode or reject_log_file_name:
+                raise EInvalidArguments(
+                    bad_arguments="several inputs can't be used with --checkpoint, --max-memory, --dedup or --reject-log")
+            data_file_names = inputs
+        if per_file_mode:
+            if not os.path.isdir(output_file_name):
+                raise EFileNotFound(filename="output directory: " + output_file_name)
+            outputs = [PerFileOutput(file_name) for file_name in inputs]
+            if len(set(outputs)) != len(outputs):
+                raise EInvalidArguments(bad_arguments="--per-file inputs with the same name would share an output")
+
+    for file_name in data_file_names or [data_file_name]:
+        if file_name and CompressionOf(file_name) == "xz" and XzDecompressor() is None and not XzCommand():
+            raise EInvalidArguments(bad_arguments="xz input needs backports.lzma or the xz command: " + file_name)
+    if index_mode and output_file_name.endswith(".gz"):
+        raise EInvalidArguments(bad_arguments="--index can't be used with gzipped output")
+
+    if resume_mode:
+        state = LoadCheckpointState()
+        if state["input"] != os.path.abspath(data_file_name) or state["size"] != os.path.getsize(data_file_name):
+            raise EInvalidArguments(bad_arguments="checkpoint was made for a different input: " + state["input"])
 
     # return values can be used for testing
     raise ENone
 
 
-def FetchNext():
+def ExpandInputs(arguments):
+    """ turns the input arguments into input files. a directory stands for every file in it,
+        and an argument with glob characters for every file it matches
+    :param arguments: input file, directory & glob arguments from the command line
+    :returns : list of file names, in argument order. each directory & glob is sorted
+    """
+    import glob
+    file_names = []
+    for argument in arguments:
+        if os.path.isdir(argument):
+            matches = [os.path.join(argument, name) for name in sorted(os.listdir(argument))]
+            matches = [name for name in matches if os.path.isfile(name)]
+        elif glob.has_magic(argument):
+            matches = sorted(name for name in glob.glob(argument) if os.path.isfile(name))
+        else:
+            matches = [argument]
+        if not matches:
+            raise EFileNotFound(filename="input files: " + argument)
+        for file_name in matches:
+            if not os.path.isfile(file_name):
+                raise EFileNotFound(filename="input file: " + file_name)
+        file_names.extend(matches)
+    return file_names
+
+
+def PerFileOutput(file_name):
+    """ --per-file: where one input's result goes, eg data.in -> <output dir>/data.result.out """
+    return os.path.join(output_file_name, os.path.splitext(os.path.basename(file_name))[0] + ".result.out")
+
+
+def CompressionOf(file_name):
+    """ :returns : "gzip", "bzip2" or "xz" from the file's first bytes, None for a plain file """
+    with open(file_name, 'rb') as input_file_handle:
+        head = input_file_handle.read(6)
+    for compression, magic in compression_magic:
+        if head.startswith(magic):
+            return compression
+    return None
+
+
+def XzDecompressor():
+    """ :returns : a new LZMADecompressor, or None if there's no lzma module (python 2 has none built in) """
+    try:
+        from backports import lzma
+    except ImportError:
+        try:
+            import lzma
+        except ImportError:
+            return None
+    return lzma.LZMADecompressor()
+
+
+def XzCommand():
+    """ :returns : True if the xz command is on the path """
+    return any(os.access(os.path.join(directory, "xz"), os.X_OK)
+               for directory in os.environ.get("PATH", "").split(os.pathsep))
+
+
+def ReadChunks(read):
+    """ generator - calls read() for block_size bytes at a time until it returns nothing """
+    while True:
+        data = read(block_size)
+        if not data:
+            return
+        yield data
+
+
+def StreamEnded(decompressor):
+    """ :returns : True if a bz2 or lzma decompressor has seen the end of its stream """
+    if hasattr(decompressor, "eof"):
+        return decompressor.eof
+    # python 2's BZ2Decompressor has no eof, but refuses any more input once it has ended
+    try:
+        decompressor.decompress("")
+    except EOFError:
+        return True
+    return False
+
+
+def DecompressedChunks(file_name, compression):
+    """ generator - decompresses a file as it is read, block_size bytes of compressed data at a time.
+        files holding several compressed streams one after another (eg from cat) are read through
+    :param file_name: compressed file
+    :param compression: as returned by CompressionOf
+    :returns : chunks of decompressed data
+    :raises IOError: when the file ends part way through a stream, so a truncated file isn't taken as complete
+    """
+    if compression == "gzip":
+        # GzipFile reads through several members, and checks the length & crc at the end of each
+        import gzip
+        with gzip.GzipFile(file_name, 'rb') as input_file_handle:
+            try:
+                for data in ReadChunks(input_file_handle.read):
+                    yield data
+            except (EOFError, struct.error):
+                # cut off inside the length & crc trailer
+                raise IOError("compressed input ends part way through a stream: " + file_name)
+        return
+    if compression == "xz" and XzDecompressor() is None:
+        import subprocess
+        xz = subprocess.Popen(["xz", "-dc", file_name], stdout=subprocess.PIPE, bufsize=block_size)
+        try:
+            for data in ReadChunks(xz.stdout.read):
+                yield data
+        finally:
+            xz.stdout.close()
+            returncode = xz.wait()
+        if returncode != 0:
+            raise IOError("xz failed with exit code %d on %s" % (returncode, file_name))
+        return
+    if compression == "bzip2":
+        import bz2
+        new_decompressor = bz2.BZ2Decompressor
+    else:
+        new_decompressor = XzDecompressor
+    decompressor = new_decompressor()
+    with open(file_name, 'rb') as input_file_handle:
+        for data in ReadChunks(input_file_handle.read):
+            while data:
+                try:
+                    yield decompressor.decompress(data)
+                except EOFError:
+                    # the last stream ended exactly where the previous read did
+                    decompressor = new_decompressor()
+                    continue
+                # anything after the end of a stream is the start of the next one
+                data = decompressor.unused_data
+                if data:
+                    decompressor = new_decompressor()
+    if not StreamEnded(decompressor):
+        raise IOError("compressed input ends part way through a stream: " + file_name)
+
+
+def LineBlocks(chunks, start=0):
+    """ generator - regroups chunks of data into blocks which end on line boundaries
+    :param chunks: iterable of strings
+    :param start: number of bytes to skip first
+    :returns : block of whole lines as a string
+    """
+    remainder = ""
+    for data in chunks:
+        if start:
+            skipped = min(start, len(data))
+            data = data[skipped:]
+            start -= skipped
+        cut = data.rfind("\n") + 1
+        if cut == 0:
+            remainder += data
+            continue
+        yield remainder + data[:cut]
+        remainder = data[cut:]
+    if remainder:
+        yield remainder
+
+
+def FetchBlocks(file_name=None, start=0, end=None):
+    """ generator - returns the input in large blocks which always end on a line boundary
+    :param file_name: file to read, None means stdin
+    :param start: byte offset to start at (files only). for compressed files, of the decompressed data
+    :param end: byte offset to stop at, None means end of file (plain files only)
+    :returns : block of whole lines as a string
+    """
+    if file_name is None:
+        # pipes can't be mapped, so read whatever is available in large chunks
+        for block in LineBlocks(ReadChunks(lambda size: os.read(sys.stdin.fileno(), size))):
+            yield block
+        return
+
+    compression = CompressionOf(file_name)
+    if compression:
+        # no mapping either, and an offset means decompressing up to it
+        for block in LineBlocks(DecompressedChunks(file_name, compression), start):
+            yield block
+        return
+
+    with open(file_name, 'rb') as input_file_handle:
+        size = os.fstat(input_file_handle.fileno()).st_size
+        if end is None or end > size:
+            end = size
+        if start >= end:
+            return
+        mapped = mmap.mmap(input_file_handle.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            position = start
+            while position < end:
+                stop = min(position + block_size, end)
+                if stop < end:
+                    cut = mapped.rfind("\n", position, stop) + 1
+                    if cut == 0:
+                        # a line longer than a block
+                        cut = mapped.find("\n", stop, end) + 1 or end
+                    stop = cut
+                yield mapped[position:stop]
+                position = stop
+        finally:
+            mapped.close()
+
+
+def InputFileName():
+    """ the file FetchBlocks should read
+    :var data_file_name (global): file to read
+    :var console_io (global): flag which tells us "input file" vs "console input"
+    :returns : data_file_name, or None for stdin when console_io is set
+    """
+    if console_io:
+        return None
+    if data_file_name is None:
+        # stdin is only ever read when asked for
+        raise EInvalidArguments(bad_arguments="No input file specified")
+    return data_file_name
+
+
+def FetchNext(start=0):
     """ generator - returns next input line
+    :param start: byte offset to start reading the file at
     :var data_file_name (global): file to read
     :var console_io (global): flag which tells us "input file" vs "console input"
     :returns : raw_line from input stream
     """
-
-    if console_io:
-        for raw_line in sys.stdin:
+    for block in FetchBlocks(InputFileName(), start):
+        for raw_line in cStringIO.StringIO(block):
             yield raw_line
-    else:
-        with open(data_file_name, 'r') as input_file_handle:
-            for raw_line in input_file_handle:
-                yield raw_line
 
 
 
@@ -215,6 +1011,42 @@ def RegexFilter(line):
 
 
 
+# the three known layouts, recognized and captured in one pass. only clean lines
+# match (single ", " separators, digits where digits belong); anything else falls
+# back to RegexFilter + NormalizeTheData, which also produces the reject reasons.
+#   Last, First, (phone), color, zip        -> groups 1, 2, 3-7
+#   First, Last, zip, phone, color          -> groups 1, 2, 8-12
+#   First Last, color, zip, phone           -> groups 1, 13-17
+name_pattern = r"[A-Za-z.\-](?:[A-Za-z.\- ]*[A-Za-z.\-])?"
+color_pattern = r"[a-z](?:[a-z ]*[a-z])?"
+layout_pattern = re.compile(
+    r"(%(name)s), (?:(%(name)s), (?:\((\d{3})\)-(\d{3})-(\d{4}), (%(color)s), (\d{5})"
+    r"|(\d{5}), (\d{3}) (\d{3}) (\d{4}), (%(color)s))"
+    r"|(%(color)s), (\d{5}), (\d{3}) (\d{3}) (\d{4}))\Z"
+    % {"name": name_pattern, "color": color_pattern})
+
+
+def MatchLayout(line):
+    """ single pass classifier for clean lines
+    :param line: stripped input line
+    :returns : (first, last, zip_code, phone, color), or None when the line needs the full rules
+    """
+    match = layout_pattern.match(line)
+    if match is None:
+        return None
+    g = match.groups()
+    if g[2] is not None:
+        return g[1], g[0], g[6], g[2] + g[3] + g[4], g[5].replace(" ", "")
+    if g[7] is not None:
+        return g[0], g[1], g[7], g[8] + g[9] + g[10], g[11].replace(" ", "")
+    # same first/last split as the 4 field rule, quirks included. the color is
+    # the second field here, so its spaces are kept
+    name = g[0].split(" ")
+    last = name[len(name)-1]
+    name.remove(last)
+    return ' '.join(name), last, g[13], g[14] + g[15] + g[16], g[12]
+
+
 def NormalizeTheData(line):
     fields_temp = line.split(",")
     fields = []
@@ -228,6 +1060,443 @@ def NormalizeTheData(line):
     return fields
 
 
+def SpillRun(interim_list_of_records):
+    """ sorts the records collected so far and writes them to a temp file
+    :param interim_list_of_records: the in memory run
+    :var sort_runs (global): gets the temp file name
+    :var checkpoint_dir (global): when set, runs are kept there instead of the temp directory
+    """
+    import tempfile
+    import cPickle
+    interim_list_of_records.sort()
+    handle, run_file_name = tempfile.mkstemp(prefix="percolate", suffix=".run", dir=checkpoint_dir)
+    with os.fdopen(handle, 'wb') as run_file:
+        pickler = cPickle.Pickler(run_file, cPickle.HIGHEST_PROTOCOL)
+        for item in interim_list_of_records:
+            # as a plain tuple. a pickled Record names the module it came from, which is __main__
+            # from the command line but PercolateTest2 when imported, eg by PercolateService
+            pickler.dump(tuple(item))
+            # the memo would otherwise keep every record alive
+            pickler.clear_memo()
+    sort_runs.append(run_file_name)
+
+
+def ReadRun(run_file_name, remove=True):
+    """ generator - returns the records of one spilled run, then deletes it
+    :param run_file_name: temp file written by SpillRun
+    :param remove: False keeps the file, eg. when it belongs to a checkpoint
+    """
+    import cPickle
+    try:
+        with open(run_file_name, 'rb') as run_file:
+            unpickler = cPickle.Unpickler(run_file)
+            while True:
+                try:
+                    yield Record._make(unpickler.load())
+                except EOFError:
+                    break
+    finally:
+        # RemoveRuns may have got there first
+        if remove and os.path.exists(run_file_name):
+            os.remove(run_file_name)
+
+
+def RemoveRuns():
+    """ deletes whatever spilled runs are left, eg when a run stops part way. runs which
+        belong to a checkpoint are kept for --resume
+    :var sort_runs (global): the runs
+    """
+    if checkpoint_dir is None:
+        for run_file_name in sort_runs:
+            if os.path.exists(run_file_name):
+                os.remove(run_file_name)
+        del sort_runs[:]
+
+
+def StartCheckpoint(list_of_errors, list_of_error_details):
+    """ prepares the checkpoint directory. when resuming, reloads the saved state
+    :param list_of_errors: filled with the errors found before the checkpoint
+    :param list_of_error_details: filled with the error details found before the checkpoint
+    :var sort_runs (global): filled with the runs saved before the checkpoint
+    :returns : (record_number, offset, errors_log, rejects_size) - where to continue from, the open
+               errors log, and how much of the reject log belongs to the checkpoint (None if starting fresh)
+    """
+    errors_log_name = os.path.join(checkpoint_dir, "errors.log")
+    if not resume_mode:
+        ClearCheckpoint()
+        if not os.path.isdir(checkpoint_dir):
+            os.makedirs(checkpoint_dir)
+        return -1, 0, open(errors_log_name, 'wb'), None
+
+    state = LoadCheckpointState()
+    for run_file_name in state["runs"]:
+        sort_runs.append(os.path.join(checkpoint_dir, run_file_name))
+
+    # anything logged after the checkpoint will be seen again
+    errors_log = open(errors_log_name, 'r+b')
+    errors_log.truncate(state["errors_size"])
+    import cPickle
+    unpickler = cPickle.Unpickler(errors_log)
+    while errors_log.tell() < state["errors_size"]:
+        detail = ErrorDetail._make(unpickler.load())
+        list_of_errors.append(detail.record)
+        if max_error_details is None or len(list_of_error_details) < max_error_details:
+            list_of_error_details.append(detail)
+    return state["record_number"], state["offset"], errors_log, state.get("rejects_size")
+
+
+def LoadCheckpointState():
+    """ reads the saved checkpoint state
+    :var checkpoint_dir (global): where the state lives
+    :returns : the state dict written by SaveCheckpoint
+    """
+    import json
+    with open(os.path.join(checkpoint_dir, "state.json"), 'r') as state_file:
+        return json.load(state_file)
+
+
+def SaveCheckpoint(interim_list_of_records, record_number, offset, errors_log, reject_log=None):
+    """ makes everything read so far durable: the in memory run is spilled and the state
+        is replaced atomically, so a crash at any point leaves the previous checkpoint usable
+    :param interim_list_of_records: the in memory run, spilled and emptied
+    :param record_number: last record processed
+    :param offset: byte offset in the input just past that record
+    :param errors_log: the open errors log
+    :param reject_log: the open --reject-log file, if any
+    """
+    if reject_log:
+        reject_log.flush()
+        os.fsync(reject_log.fileno())
+    if interim_list_of_records:
+        SpillRun(interim_list_of_records)
+        del interim_list_of_records[:]
+    errors_log.flush()
+    os.fsync(errors_log.fileno())
+    state = {"input": os.path.abspath(data_file_name), "size": os.path.getsize(data_file_name),
+             "offset": offset, "record_number": record_number, "errors_size": errors_log.tell(),
+             "rejects_size": reject_log.tell() if reject_log else None,
+             "runs": [os.path.basename(run_file_name) for run_file_name in sort_runs]}
+    state_file_name = os.path.join(checkpoint_dir, "state.json")
+    import json
+    with open(state_file_name + ".tmp", 'w') as state_file:
+        json.dump(state, state_file)
+        state_file.flush()
+        os.fsync(state_file.fileno())
+    if os.name == 'nt' and os.path.exists(state_file_name):
+        os.remove(state_file_name)
+    os.rename(state_file_name + ".tmp", state_file_name)
+
+
+def ClearCheckpoint():
+    """ removes the checkpoint state and runs once they are no longer needed """
+    if checkpoint_dir is None or not os.path.isdir(checkpoint_dir):
+        return
+    for file_name in os.listdir(checkpoint_dir):
+        if file_name.endswith(".run") or file_name in ("state.json", "state.json.tmp", "errors.log"):
+            os.remove(os.path.join(checkpoint_dir, file_name))
+
+
+def ProcessLine(raw_line):
+    """ applies the rules & data integrity checks to one input line
+    :param raw_line: line as read from the input
+    :returns : (error, new_record). error is None when the line was accepted,
+               otherwise new_record (a Record) is None
+    """
+    # bytes all the way, MakeRecord decodes the fields of accepted lines
+    line = raw_line.strip()
+
+    fields = MatchLayout(line)
+    if fields is None:
+        error, fields = ClassifyFields(line)
+        if error:
+            return error, None
+    first, last, zip_code, phone, color = fields
+
+    # unknown color?
+    if color not in valid_colors:
+        return "unkcolor: " + color, None
+
+    # invalid zip?
+    if len(zip_code) > 5 or len(zip_code) < 5:
+        return "badzip: " + zip_code, None
+
+    # invalid phone
+    phone = phone.replace(" ", "")
+    phone = phone.replace("-", "")
+    if len(phone) > 10 or len(phone) < 7:
+        return "badphone: " + phone, None
+
+    return None, MakeRecord(first, last, zip_code, phone, color)
+
+
+def MakeRecord(first, last, zip_code, phone, color):
+    """ packages up the fields of an accepted line for the next step
+    :returns : the Record, as text. the rules only let ascii through into the fields, and
+               ascii decodes the same in every encoding --encoding allows, so the quick
+               default (ascii) codec is used rather than input_encoding
+    """
+    # one decode for all five fields is about half the cost of five. no field can hold a \0
+    first, last, zip_code, phone, color = unicode("\0".join((first, last, zip_code, phone, color))).split(u"\0")
+    # names the wrong way round?
+    if name_index is not None and last in name_index and first not in name_index:
+        first, last = last, first
+    if canonical_colors:
+        color = valid_colors[color]
+    return Record(last + ", " + first, color, first, last, phone, zip_code)
+
+
+def ProcessBlock(raw_lines):
+    """ the numpy engine - ProcessLine for a block of lines at once. layouts are still
+        recognized line by line, then the color, zip & phone checks run over the block as arrays
+    :param raw_lines: list of input lines
+    :returns : list of (error, new_record), exactly what ProcessLine gives for each line
+    """
+    results = [None] * len(raw_lines)
+    candidates = []
+    columns = ([], [], [], [], [])
+    for index, raw_line in enumerate(raw_lines):
+        line = raw_line.strip()
+        fields = MatchLayout(line)
+        if fields is None:
+            error, fields = ClassifyFields(line)
+            if error:
+                results[index] = (error, None)
+                continue
+        candidates.append(index)
+        for column, value in zip(columns, fields):
+            column.append(value)
+    if not candidates:
+        return results
+
+    first, last, zip_code, phone, color = columns
+    known_color = numpy.in1d(numpy.array(color, dtype=unicode), numpy.array(valid_colors.keys(), dtype=unicode))
+    zip_ok = numpy.char.str_len(numpy.array(zip_code, dtype=unicode)) == 5
+    phones = numpy.char.replace(numpy.char.replace(numpy.array(phone, dtype=unicode), u" ", u""), u"-", u"")
+    phone_length = numpy.char.str_len(phones)
+    phone_ok = (phone_length >= 7) & (phone_length <= 10)
+    phone = phones.tolist()
+
+    # same precedence as ProcessLine: color, then zip, then phone
+    accepted = known_color & zip_ok & phone_ok
+    for k, index in enumerate(candidates):
+        if accepted[k]:
+            results[index] = (None, MakeRecord(first[k], last[k], zip_code[k], phone[k], color[k]))
+        elif not known_color[k]:
+            results[index] = ("unkcolor: " + color[k], None)
+        elif not zip_ok[k]:
+            results[index] = ("badzip: " + zip_code[k], None)
+        else:
+            results[index] = ("badphone: " + phone[k], None)
+    return results
+
+
+def ProcessLines(raw_lines):
+    """ runs the selected engine over a list of lines
+    :param raw_lines: list of input lines
+    :returns : list of (error, new_record), one per line
+    """
+    if engine == "numpy":
+        return ProcessBlock(raw_lines)
+    return [ProcessLine(raw_line) for raw_line in raw_lines]
+
+
+def ClassifyFields(line):
+    """ the full rules for lines MatchLayout doesn't recognize
+    :param line: stripped input line
+    :returns : (error, fields). fields is (first, last, zip_code, phone, color), or None on error
+    """
+    # rules
+    # only lines with commas are good
+    if "," not in line:
+        return "nocomma", None
+
+    # regex filter to keep letters, numbers, commas, periods and spaces
+    line = RegexFilter(line)
+
+    # normalize the data
+    fields = NormalizeTheData(line)
+
+    # do we have enough fields
+    number_of_fields = len(fields)
+    if number_of_fields < 4 or number_of_fields > 5:
+        return "wrong#fields:" + str(number_of_fields), None
+
+    # find the color to determine field order
+    # and start building the new record
+    if number_of_fields == 4:
+        name = fields[0].split(" ")
+        last = name[len(name)-1]
+        name.remove(last)
+        first = ' '.join(name)
+        zip_code = fields[2]
+        phone = fields[3]
+        color = fields[1]
+    elif not fields[4].isdigit():
+        first = fields[0]
+        last = fields[1]
+        zip_code = fields[2]
+        phone = fields[3]
+        color = fields[4]
+    elif not fields[3].isdigit():
+        last = fields[0]
+        first = fields[1]
+        phone = fields[2]
+        color = fields[3]
+        zip_code = fields[4]
+    else:
+        return "nocolor", None
+
+    return None, (first, last, zip_code, phone, color)
+
+
+def SplitChunks(file_name, number_of_chunks):
+    """ splits a file into byte ranges which start and end on line boundaries
+    :param file_name: file to split
+    :param number_of_chunks: how many ranges to aim for
+    :returns : list of (file_name, start, end) tuples, in file order
+    """
+    size = os.path.getsize(file_name)
+    boundaries = [0]
+    with open(file_name, 'rb') as input_file_handle:
+        for i in range(1, number_of_chunks):
+            position = size * i / number_of_chunks
+            if position <= boundaries[-1]:
+                continue
+            input_file_handle.seek(position - 1)
+            # finish the line we landed in, the next one starts the chunk
+            input_file_handle.readline()
+            position = input_file_handle.tell()
+            if position >= size:
+                break
+            if position > boundaries[-1]:
+                boundaries.append(position)
+    boundaries.append(size)
+    return [(file_name, boundaries[i], boundaries[i + 1]) for i in range(len(boundaries) - 1)]
+
+
+# settings ProcessArgs makes which the -j and batch workers read
+worker_options = ["valid_colors", "canonical_colors", "engine", "dedup_mode", "dedup_report", "verbose_mode",
+                  "max_memory", "checkpoint_dir", "reject_log_file_name", "max_error_details", "output_offset",
+                  "output_limit", "index_mode", "output_file_name", "input_encoding"]
+
+
+def WorkerOptions():
+    """ snapshot of the settings for a worker pool. forked workers inherit them anyway, but
+        spawned ones (windows) would otherwise start from the module defaults
+    :returns : dict for StartWorker
+    """
+    options = dict((name, globals()[name]) for name in worker_options)
+    # the name index is a memory map and stats hold the run's counters, neither can be sent
+    options["name_order"] = name_index is not None
+    options["collect_stats"] = stats is not None
+    return options
+
+
+def StartWorker(options):
+    """ Pool initializer - applies WorkerOptions from the parent in a worker process """
+    global name_index
+    global stats
+    options = dict(options)
+    name_order = options.pop("name_order")
+    collect_stats = options.pop("collect_stats")
+    globals().update(options)
+    if engine == "numpy":
+        LoadNumpy()
+    name_index = OpenNameIndex() if name_order else None
+    stats = StartStats() if collect_stats else None
+
+
+def ProcessChunk(chunk):
+    """ worker - runs ProcessLine over one byte range of the input file
+    :param chunk: (file_name, start, end) as returned by SplitChunks
+    :returns : list of (error, new_record, raw_line) in line order. raw_line is
+               only kept for rejected lines, or for every line with --dedup-report
+    """
+    file_name, start, end = chunk
+    results = []
+    for block in FetchBlocks(file_name, start, end):
+        raw_lines = cStringIO.StringIO(block).readlines()
+        for raw_line, (error, new_record) in zip(raw_lines, ProcessLines(raw_lines)):
+            results.append((error, new_record, raw_line if error or dedup_report else None))
+    return results
+
+
+def ProcessedLines(start=0):
+    """ generator - runs the rules over every input line, using a process pool when jobs > 1
+    :param start: byte offset to start at
+    :var jobs (global): number of worker processes
+    :returns : (error, new_record, raw_line) in input order
+    """
+    if jobs > 1 and not console_io and checkpoint_dir is None and not CompressionOf(data_file_name):
+        import multiprocessing
+        number_of_chunks = max(jobs * 4, os.path.getsize(data_file_name) / chunk_size + 1)
+        pool = multiprocessing.Pool(jobs, StartWorker, (WorkerOptions(),))
+        try:
+            # imap keeps the chunks in file order, so record numbers come out right
+            for results in pool.imap(ProcessChunk, SplitChunks(data_file_name, number_of_chunks)):
+                for result in results:
+                    if stats is not None:
+                        # the time was spent in the workers, only the counts are known here
+                        RecordRule(result[0])
+                    yield result
+            pool.close()
+        finally:
+            pool.terminate()
+            pool.join()
+    elif engine != "scalar":
+        for block in FetchBlocks(InputFileName(), start):
+            raw_lines = cStringIO.StringIO(block).readlines()
+            for raw_line, (error, new_record) in zip(raw_lines, ProcessLines(raw_lines)):
+                if stats is not None:
+                    # lines are checked a block at a time, so there is no per line time
+                    RecordRule(error)
+                yield error, new_record, raw_line
+    elif stats is not None:
+        clock = time.time
+        for raw_line in FetchNext(start):
+            started = clock()
+            error, new_record = ProcessLine(raw_line)
+            RecordRule(error, clock() - started)
+            yield error, new_record, raw_line
+    else:
+        for raw_line in FetchNext(start):
+            error, new_record = ProcessLine(raw_line)
+            yield error, new_record, raw_line
+
+
+def DedupKey(record):
+    """ the identity of a person for duplicate detection
+    :param record: Record from ProcessLine
+    :returns : normalized (last, first, phone, zip) joined into one string, which is
+               much smaller to keep in the index than a tuple
+    """
+    return u"\x00".join((record.last.lower(), record.first.lower(), record.phone, record.zip))
+
+
+def OpenRejectLog(size=None):
+    """ opens the --reject-log file
+    :param size: when resuming, the size the log had at the checkpoint. anything after that is dropped
+    :returns : the open file
+    """
+    if size is None:
+        return open(reject_log_file_name, 'wb')
+    reject_log = open(reject_log_file_name, 'r+b')
+    reject_log.truncate(size)
+    reject_log.seek(size)
+    return reject_log
+
+
+def TrimRecords(interim_list_of_records, keep_limit):
+    """ --limit: cuts the in memory run back to the records which can still be written.
+        called each time the run doubles, so the sorting costs O(n log k) over the whole input,
+        and in C, where a heap of k records would need a max heap in pure python
+    :param interim_list_of_records: the in memory run, trimmed in place
+    :param keep_limit: how many of the smallest records to keep
+    """
+    interim_list_of_records.sort()
+    del interim_list_of_records[keep_limit:]
+
+
 def BuildRecordList():
     """ heavy lifting = rules processing & data integrity checks """
 
@@ -235,109 +1504,193 @@ def BuildRecordList():
     list_of_errors = []
     list_of_error_details = []
 
+    del sort_runs[:]
+    if max_memory:
+        run_limit = max(1, max_memory * 1024 * 1024 / record_cost_estimate)
+    else:
+        run_limit = None
+    # with --limit only the first output_offset + output_limit entries can ever be written
+    keep_limit = output_offset + output_limit if output_limit else None
+
+    # dedup key -> record number of the first copy
+    dedup_index = {} if dedup_mode else None
+
     record_number = -1
+    offset = 0
+    errors_log = None
+    reject_log = None
     try:
+        rejects_size = None
+        if checkpoint_dir:
+            record_number, offset, errors_log, rejects_size = StartCheckpoint(list_of_errors, list_of_error_details)
+            import cPickle
+            errors_pickler = cPickle.Pickler(errors_log, cPickle.HIGHEST_PROTOCOL)
+            next_checkpoint = record_number + checkpoint_interval
+        if reject_log_file_name:
+            import json
+            reject_log = OpenRejectLog(rejects_size)
+
         # now process the file
-        for raw_line in FetchNext():
+        for error, new_record, raw_line in ProcessedLines(offset):
             record_number += 1
-            line = unicode(raw_line.strip())
-
-            # rules
-            # only lines with commas are good
-            if "," not in line:
-                list_of_errors.append(record_number)
-                list_of_error_details.append({"record": record_number, "error": "nocomma", "line": raw_line})
-                continue
 
-            # regex filter to keep letters, numbers, commas, periods and spaces
-            line = RegexFilter(line)
+            if dedup_index is not None and new_record is not None:
+                first_copy = dedup_index.setdefault(DedupKey(new_record), record_number)
+                if first_copy != record_number:
+                    new_record = None
+                    if dedup_report:
+                        error = "duplicate: %d" % first_copy
 
-            # normalize the data
-            fields = NormalizeTheData(line)
-
-            # do we have enough fields
-            number_of_fields = len(fields)
-            if number_of_fields < 4 or number_of_fields > 5:
+            if error:
                 list_of_errors.append(record_number)
-                list_of_error_details.append({"record": record_number,
-                                              "error": "wrong#fields:" + str(number_of_fields), "line": raw_line})
-                continue
-
-            # find the color to determine field order
-            # and start building the new record
-            if number_of_fields == 4:
-                name = fields[0].split(" ")
-                last = name[len(name)-1]
-                name.remove(last)
-                first = ' '.join(name)
-                zip_code = fields[2]
-                phone = fields[3]
-                color = fields[1]
-            elif not fields[4].isnumeric():
-                first = fields[0]
-                last = fields[1]
-                zip_code = fields[2]
-                phone = fields[3]
-                color = fields[4]
-            elif not fields[3].isnumeric():
-                last = fields[0]
-                first = fields[1]
-                phone = fields[2]
-                color = fields[3]
-                zip_code = fields[4]
-            else:
-                list_of_errors.append(record_number)
-                list_of_error_details.append({"record": record_number, "error": "nocolor", "line": raw_line})
-                continue
-
-            # unknown color?
-            if color not in valid_colors:
-                list_of_errors.append(record_number)
-                list_of_error_details.append({"record": record_number, "error": "unkcolor: " + color, "line": raw_line})
-                continue
-
-            # invalid zip?
-            if len(zip_code) > 5 or len(zip_code) < 5:
-                list_of_errors.append(record_number)
-                list_of_error_details.append({"record": record_number, "error": "badzip: " + zip_code, "line": raw_line})
-                continue
-
-            # invalid phone
-            phone = phone.replace(" ", "")
-            phone = phone.replace("-", "")
-            if len(phone) > 10 or len(phone) < 7:
-                list_of_errors.append(record_number)
-                list_of_error_details.append({"record": record_number, "error": "badphone: " + phone, "line": raw_line})
-                continue
-
-            # package up the data for the next step
-            new_record = (last + ", " + first,
-                          {u"color": color, u"first": first, u"last": last, u"phone": phone, u"zip": zip_code})
-            interim_list_of_records.append(new_record)
+                detail = ErrorDetail(record_number, error, raw_line)
+                if max_error_details is None or len(list_of_error_details) < max_error_details:
+                    list_of_error_details.append(detail)
+                if reject_log:
+                    reject_log.write(json.dumps(detail.AsDict(), sort_keys=True) + "\n")
+                if errors_log:
+                    errors_pickler.dump(tuple(detail))
+            elif new_record is not None:
+                interim_list_of_records.append(new_record)
+                if keep_limit and len(interim_list_of_records) >= 2 * keep_limit:
+                    TrimRecords(interim_list_of_records, keep_limit)
+                if run_limit and len(interim_list_of_records) >= run_limit:
+                    SpillRun(interim_list_of_records)
+                    interim_list_of_records = []
+
+            if errors_log:
+                offset += len(raw_line)
+                if record_number >= next_checkpoint:
+                    SaveCheckpoint(interim_list_of_records, record_number, offset, errors_log, reject_log)
+                    next_checkpoint = record_number + checkpoint_interval
+
+        if errors_log:
+            errors_log.close()
+        if reject_log:
+            reject_log.close()
 
     except Exception as e:
         print
         sys.stderr.write("error - unknown input file error\n")
         sys.stderr.write("%s\n" % e)
+        import traceback
         traceback.print_exc()
+        RemoveRuns()
         sys.exit(5)
 
     # return values can be used for testing
     return interim_list_of_records, list_of_errors, list_of_error_details
 
 
+def ProcessFile(file_name):
+    """ batch worker - runs the rules over one whole input file
+    :param file_name: input file
+    :returns : (file_name, sorted records, errors, error details, stats for MergeStats)
+    """
+    global data_file_name
+    global jobs
+    data_file_name = file_name
+    # workers can't have pools of their own
+    jobs = 1
+    if stats is not None:
+        # this file's counts alone. the worker's stats are lost with it, so they go back to BuildBatch
+        StartStats()
+    try:
+        interim_list_of_records, list_of_errors, list_of_error_details = BuildRecordList()
+    except SystemExit as e:
+        # BuildRecordList has already said why. a worker which exits would leave the pool waiting for it
+        raise RuntimeError("%s failed with exit code %s" % (file_name, e.code))
+    interim_list_of_records.sort()
+    file_stats = None
+    if stats is not None:
+        file_stats = stats.lines, stats.get("first_record"), stats.rule_counts, stats.rule_seconds
+    return file_name, interim_list_of_records, list_of_errors, list_of_error_details, file_stats
+
+
+def OutputFile(file_name):
+    """ --per-file worker - processes one input file into its own result
+    :param file_name: input file
+    :returns : (file_name, output file name, number of entries, number of errors, stats for MergeStats)
+    """
+    file_name, interim_list_of_records, list_of_errors, list_of_error_details, file_stats = ProcessFile(file_name)
+    number_of_entries = len(interim_list_of_records)
+    data = SortAndFinalize(interim_list_of_records, list_of_errors, list_of_error_details)
+    with OpenOutput(PerFileOutput(file_name)) as output_file:
+        if index_mode:
+            index_writer = EntryIndexWriter(PerFileOutput(file_name) + ".idx")
+            data["entries"] = index_writer.Sample(data["entries"])
+            StreamWriter(output_file, index_writer).WriteDocument(data)
+            index_writer.Finish()
+        else:
+            StreamWriter(output_file).WriteDocument(data)
+    return file_name, PerFileOutput(file_name), number_of_entries, len(list_of_errors), file_stats
+
+
+def BuildBatch():
+    """ batch mode: processes every input file in a pool of worker processes
+    :var data_file_names (global): input files
+    :var jobs (global): files processed at once, defaults to one per cpu
+    :returns : the JSON ready collection for every file merged, errors as "<file name>:<record>",
+               or None with --per-file, where the workers have written every result themselves
+    """
+    import multiprocessing
+    pool = multiprocessing.Pool(min(jobs if jobs > 1 else multiprocessing.cpu_count(), len(data_file_names)),
+                                StartWorker, (WorkerOptions(),))
+    try:
+        if per_file_mode:
+            for file_name, output, number_of_entries, number_of_errors, file_stats in pool.imap(OutputFile,
+                                                                                                data_file_names):
+                MergeStats(file_stats)
+                print "%s -> %s: %d entries, %d errors" % (file_name, output, number_of_entries, number_of_errors)
+            pool.close()
+            return None
+        interim_list_of_records = []
+        list_of_errors = []
+        list_of_error_details = []
+        for file_name, records, errors, error_details, file_stats in pool.imap(ProcessFile, data_file_names):
+            MergeStats(file_stats)
+            interim_list_of_records.extend(records)
+            list_of_errors.extend("%s:%d" % (file_name, record_number) for record_number in errors)
+            list_of_error_details.extend(detail._replace(record="%s:%d" % (file_name, detail.record))
+                                         for detail in error_details)
+        pool.close()
+    except RuntimeError as e:
+        sys.stderr.write("error - %s\n" % e)
+        sys.exit(5)
+    finally:
+        pool.terminate()
+        pool.join()
+    # every file's records arrive sorted, and sort merges runs like that in close to linear time
+    return SortAndFinalize(interim_list_of_records, list_of_errors, list_of_error_details)
+
+
 def SortAndFinalize(interim_list_of_records, list_of_errors, list_of_error_details):
     """
     :param interim_list_of_records: list of records already generated
     :param list_of_errors:
     :param list_of_error_details:
-    :return data: the JSON ready collection
+    :var sort_runs (global): runs spilled by BuildRecordList, merged with the in memory run
+    :var output_offset, output_limit (global): the slice of entries to keep
+    :return data: the JSON ready collection. entries is a generator so the
+                  records are handed to OutputResults one at a time
     """
     # sort...
     interim_list_of_records.sort()
-    list_of_records = []
-    for item in interim_list_of_records:
-        list_of_records.append(item[1])
+    if sort_runs:
+        runs = [ReadRun(run_file_name, checkpoint_dir is None) for run_file_name in sort_runs]
+        runs.append(iter(interim_list_of_records))
+        import heapq
+        merged = heapq.merge(*runs)
+    else:
+        merged = interim_list_of_records
+    if output_offset or output_limit:
+        stop = output_offset + output_limit if output_limit else None
+        if sort_runs:
+            import itertools
+            merged = itertools.islice(merged, output_offset, stop)
+        else:
+            merged = merged[output_offset:stop]
+    list_of_records = merged
 
     # finalize...
     if verbose_mode:
@@ -348,34 +1701,504 @@ def SortAndFinalize(interim_list_of_records, list_of_errors, list_of_error_detai
     return data
 
 
+# the entry & error detail schemas, pre-rendered with sorted keys at the indentation
+# StreamWriter puts them (inside a list inside the top level object)
+entry_template = '{\n      "color": %s, \n      "first": %s, \n      "last": %s, \n      "phone": %s, \n      "zip": %s\n    }'
+error_detail_template = '{\n      "error": %s, \n      "line": %s, \n      "record": %d\n    }'
+
+
+def encode_string(text):
+    """ json's string encoder. imports json on first use and then puts json's own
+        encoder in its place, so after the first string there's no extra call
+    """
+    global encode_string
+    import json
+    encode_string = json.encoder.encode_basestring_ascii
+    return encode_string(text)
+
+
+def EncodeEntry(record):
+    """ fast path for json.dumps(record, sort_keys=True, indent=2) at list depth 2
+    :param record: Record, or entry dict
+    :returns : the json text, or None if the record doesn't fit the entry schema
+    """
+    if type(record) is Record:
+        return entry_template % (encode_string(record.color), encode_string(record.first),
+                                 encode_string(record.last), encode_string(record.phone),
+                                 encode_string(record.zip))
+    if len(record) != 5:
+        return None
+    try:
+        return entry_template % (encode_string(record[u"color"]), encode_string(record[u"first"]),
+                                 encode_string(record[u"last"]), encode_string(record[u"phone"]),
+                                 encode_string(record[u"zip"]))
+    except (KeyError, TypeError):
+        return None
+
+
+def EncodeErrorDetail(detail):
+    """ fast path for json.dumps(detail, sort_keys=True, indent=2) at list depth 2
+    :param detail: ErrorDetail, or error detail dict
+    :returns : the json text, or None if the detail doesn't fit the error detail schema
+    """
+    if type(detail) is ErrorDetail:
+        detail = detail.AsDict()
+    if len(detail) != 3 or type(detail.get("record")) is not int:
+        return None
+    try:
+        return error_detail_template % (encode_string(detail["error"]), encode_string(detail["line"]),
+                                        detail["record"])
+    except (KeyError, TypeError):
+        return None
+
+
+class StreamWriter(object):
+    """ writes the result document one piece at a time to one or more handles.
+        the output is byte for byte what json.dump(data, sort_keys=True, indent=2)
+        produces, but no more than one record is ever serialized at once.
+    """
+    indent = "  "
+    # top level key -> fast encoder for its elements, see EncodeEntry
+    encoders = {"entries": EncodeEntry, "error_details": EncodeErrorDetail}
+
+    def __init__(self, *handles):
+        self.handles = handles
+
+    def write(self, text):
+        """ tees text to every handle """
+        for handle in self.handles:
+            handle.write(text)
+
+    def WriteList(self, items, depth, encode=None, key=None):
+        """ writes one json array, element by element
+        :param items: any iterable of json serializable values
+        :param depth: nesting level of the array's elements
+        :param encode: optional fast encoder for the elements, returning None for any it can't handle
+        :param key: name of the array, used to say where the output went wrong in test mode
+        """
+        prefix = "\n" + self.indent * depth
+        separator = "[" + prefix
+        first = True
+        for index, item in enumerate(items):
+            text = encode(item) if encode else None
+            if text is None:
+                if isinstance(item, (Record, ErrorDetail)):
+                    item = item.AsDict()
+                import json
+                text = json.dumps(item, sort_keys=True, indent=2).replace("\n", prefix)
+            try:
+                self.write(separator + text)
+            except ECanonicalMismatch as e:
+                e.Locate(key, index)
+                raise
+            separator = ", " + prefix
+            first = False
+        if first:
+            self.write("[]")
+        else:
+            self.write("\n" + self.indent * (depth - 1) + "]")
+
+    def WriteDocument(self, data):
+        """ writes the top level object. every value in data is an iterable
+        :param data: dict of key -> iterable of records
+        """
+        import json
+        prefix = "\n" + self.indent
+        separator = "{" + prefix
+        for key in sorted(data.keys()):
+            self.write(separator + json.dumps(key) + ": ")
+            self.WriteList(data[key], 2, self.encoders.get(key), key)
+            separator = ", " + prefix
+        self.write("\n}")
+
+
+class DigestCheck(object):
+    """ output sink for test mode against a golden digest manifest (a file whose first
+        word is the sha1 of the expected output, eg from sha1sum). keeps a rolling digest
+        of everything written, which Finish compares with the manifest
+    """
+
+    def __init__(self, file_name):
+        import hashlib
+        with open(file_name, 'r') as manifest:
+            self.expected_digest = manifest.read().split()[0].lower()
+        self.digest = hashlib.sha1()
+        self.offset = 0
+
+    def write(self, text):
+        self.digest.update(text)
+        self.offset += len(text)
+
+    def Finish(self):
+        """ raises ECanonicalMismatch unless the whole output matched """
+        if self.digest.hexdigest() != self.expected_digest:
+            raise ECanonicalMismatch(offset=self.offset, expected="sha1 " + self.expected_digest,
+                                     actual="sha1 " + self.digest.hexdigest())
+
+
+def LineAround(text, at):
+    """ :returns : the line of text holding position at. a line break at that position belongs
+                   to the line after it, which is where the two versions go their own ways
+    """
+    if text[at:at + 1] == "\n":
+        at += 1
+    return text[text.rfind("\n", 0, at) + 1:].split("\n")[0]
+
+
+class CanonicalCheck(object):
+    """ output sink for test mode which reads the canonical file alongside the output,
+        so a regression stops at the first divergent byte instead of after the whole run.
+        the bytes are compared directly, there is no digest to keep
+    """
+
+    def __init__(self, file_name):
+        self.canonical = open(file_name, 'rb')
+        self.offset = 0
+        # the unfinished line written so far, the same in both versions
+        self.line = ""
+
+    def write(self, text):
+        expected = self.canonical.read(len(text))
+        if expected != text:
+            self.Mismatch(text, expected)
+        self.offset += len(text)
+        cut = text.rfind("\n")
+        self.line = text[cut + 1:] if cut >= 0 else self.line + text
+
+    def Mismatch(self, text, expected):
+        """ raises ECanonicalMismatch showing the differing line of both versions """
+        at = 0
+        while at < len(text) and at < len(expected) and text[at] == expected[at]:
+            at += 1
+        if at < len(expected):
+            # enough of the canonical file to finish the line, or the one after a line break
+            rest = self.canonical.readline() + self.canonical.readline()
+            expected_line = LineAround(self.line + expected + rest, len(self.line) + at)
+        else:
+            expected_line = "(end of file)"
+        actual_line = LineAround(self.line + text, len(self.line) + at) if at < len(text) else "(end of output)"
+        raise ECanonicalMismatch(offset=self.offset + at, expected=expected_line, actual=actual_line)
+
+    def Finish(self):
+        """ raises ECanonicalMismatch if the canonical file has more to it than the output """
+        extra = self.canonical.readline()
+        if extra:
+            extra += self.canonical.readline()
+        self.canonical.close()
+        if extra:
+            raise ECanonicalMismatch(offset=self.offset, expected=LineAround(self.line + extra, len(self.line)),
+                                     actual="(end of output)")
+
+
+def OpenCanonicalCheck(file_name):
+    """ picks the test mode check for a canonical file: a .sha1 file is a digest manifest,
+        anything else is canonical output to compare byte for byte
+    """
+    if file_name.endswith(".sha1"):
+        return DigestCheck(file_name)
+    return CanonicalCheck(file_name)
+
+
+class GzipOutput(object):
+    """ output file for names ending .gz. GzipFile compresses on every write, so the many small
+        writes StreamWriter makes are gathered up and compressed block_size at a time
+    """
+
+    def __init__(self, file_name):
+        import gzip
+        self.output = gzip.open(file_name, 'wb', output_compress_level)
+        self.pending = []
+        self.pending_size = 0
+
+    def write(self, text):
+        self.pending.append(text)
+        self.pending_size += len(text)
+        if self.pending_size >= block_size:
+            self.flush()
+
+    def flush(self):
+        self.output.write("".join(self.pending))
+        self.pending = []
+        self.pending_size = 0
+
+    def close(self):
+        self.flush()
+        self.output.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def OpenOutput(file_name):
+    """ opens an output file for writing, gzipped if its name ends .gz """
+    if file_name.endswith(".gz"):
+        return GzipOutput(file_name)
+    return open(file_name, 'w')
+
+
+class EntryIndexWriter(object):
+    """ output sink which builds the sidecar index read by EntryIndex. counts the bytes of
+        output, and notes the key & offset of every index_block'th entry as it goes by
+    """
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+        self.offset = 0
+        self.samples = []
+
+    def write(self, text):
+        # the output is all ascii, so characters are bytes
+        self.offset += len(text)
+
+    def Sample(self, entries):
+        """ generator - passes the entries through. each is handed on before any of it is
+            written, so the offset noted is where its separator starts
+        """
+        for number, record in enumerate(entries):
+            if number % index_block == 0:
+                key = record.key.encode("utf-8") if isinstance(record.key, unicode) else record.key
+                self.samples.append((key, self.offset))
+            yield record
+
+    def Finish(self):
+        """ writes the index file """
+        key_width = max([len(key) for key, offset in self.samples] + [1])
+        slot = struct.Struct(EntryIndex.slot_format % key_width)
+        with open(self.file_name, 'wb') as index_file:
+            index_file.write(EntryIndex.header.pack(EntryIndex.magic, slot.size, len(self.samples), self.offset))
+            for key, offset in self.samples:
+                index_file.write(slot.pack(key, offset))
+
+
+class EntryIndex(object):
+    """ read only sidecar index of a result file, memory mapped from a file written by
+        EntryIndexWriter. the file is a header followed by fixed width, sorted slots of
+        zero padded key & byte offset, so a search is a binary search of the slots
+    """
+    header = struct.Struct("<4sIIQ")
+    magic = "PEX1"
+    slot_format = "<%dsQ"
+
+    def __init__(self, file_name, output_file_name):
+        with open(file_name, 'rb') as index_file:
+            self.mapped = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.slot_width, self.number_of_slots, output_size = self.header.unpack_from(self.mapped)
+        if magic != self.magic:
+            raise ValueError("not an entry index: " + file_name)
+        if output_size != os.path.getsize(output_file_name):
+            raise EInvalidArguments(bad_arguments="index is out of date: " + file_name)
+        self.slot = struct.Struct(self.slot_format % (self.slot_width - 8))
+
+    def Sample(self, number):
+        """ :returns : (key, offset) of one slot """
+        key, offset = self.slot.unpack_from(self.mapped, self.header.size + number * self.slot_width)
+        return key.rstrip("\0"), offset
+
+    def Find(self, key):
+        """ where to start reading the output for entries at or after key
+        :returns : byte offset of the last sampled entry before key, or None if there are no entries
+        """
+        if self.number_of_slots == 0:
+            return None
+        low, high = 0, self.number_of_slots
+        while low < high:
+            middle = (low + high) / 2
+            if self.Sample(middle)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        # entries equal to key can come just before the first sample which is
+        return self.Sample(max(low - 1, 0))[1]
+
+
 def OutputResults(data):
     """ writes results
     :param data: the JSON ready data to write
     :var verbose_mode : tells the code to write to console too
+    :var test_mode : output is also checked against canonical_output_file as it is written
+    :var output_file_name : file to write
+    :var index_mode : also write the sidecar index, <output_file_name>.idx
     """
     global verbose_mode
+    global canonical_check
+    handles = []
+    canonical_check = None
+    if test_mode and canonical_output_file is not None:
+        canonical_check = OpenCanonicalCheck(canonical_output_file)
+        handles.append(canonical_check)
+    index_writer = None
+    if index_mode:
+        index_writer = EntryIndexWriter(output_file_name + ".idx")
+        handles.append(index_writer)
+        data = dict(data, entries=index_writer.Sample(data["entries"]))
     # output...
-    with open('result.out', 'w') as output_file:
-        json.dump(data, output_file, sort_keys=True, indent=2)
+    with OpenOutput(output_file_name) as output_file:
+        handles.append(output_file)
+        if verbose_mode:
+            sys.stdout.write("json:\n")
+            handles.append(sys.stdout)
+            StreamWriter(*handles).WriteDocument(data)
+            sys.stdout.write("\n")
+        else:
+            StreamWriter(*handles).WriteDocument(data)
+    if index_writer:
+        index_writer.Finish()
 
-    if verbose_mode:
-        print "json:\n", json.dumps(data, sort_keys=True, indent=2)
+
+def StreamResults(output=None):
+    """ --stream: writes every entry, and every reject as an error detail, as one line of JSON each.
+        output is flushed after every block read, so a slow trickle of input comes straight
+        back out, and a full pipe downstream simply blocks the next read
+    :param output: file to write to, defaults to stdout
+    """
+    import json
+    output = output or sys.stdout
+    record_number = -1
+    try:
+        for block in FetchBlocks(InputFileName()):
+            raw_lines = cStringIO.StringIO(block).readlines()
+            for raw_line, (error, new_record) in zip(raw_lines, ProcessLines(raw_lines)):
+                record_number += 1
+                if error:
+                    output.write(json.dumps({"record": record_number, "error": error, "line": DecodeText(raw_line)},
+                                            sort_keys=True) + "\n")
+                else:
+                    output.write(json.dumps(new_record.AsDict(), sort_keys=True) + "\n")
+            output.flush()
+    except IOError as e:
+        # whoever was reading has gone away
+        if e.errno != errno.EPIPE:
+            raise
+
+
+def ErrorRow(record, error_details):
+    """ one row of the errors table
+    :param record: record number from the errors list
+    :param error_details: dict of record number -> ErrorDetail, for the details being written
+    :returns : (record, error, line). error & line are None when there's no detail
+    """
+    detail = error_details.get(record)
+    if detail is None:
+        return record, None, None
+    # sqlite3 only takes ascii in a str
+    return record, DecodeText(detail.error), DecodeText(detail.line)
+
+
+def InsertRows(connection, statement, rows):
+    """ bulk loads rows, sqlite_batch at a time, each batch one executemany in its own transaction
+    :param connection: sqlite3 connection in autocommit mode
+    :param statement: the INSERT
+    :param rows: iterable of parameter tuples, consumed as it goes
+    """
+    import itertools
+    rows = iter(rows)
+    while True:
+        connection.execute("BEGIN")
+        cursor = connection.executemany(statement, itertools.islice(rows, sqlite_batch))
+        connection.execute("COMMIT")
+        if cursor.rowcount < sqlite_batch:
+            break
+
+
+def OutputSqlite(data):
+    """ --format sqlite: writes results into a SQLite database rather than JSON. the records
+        go straight in, entries in sorted order as position 1, 2, ..., and the indexes are
+        built after the load, which is much quicker than keeping them up to date row by row
+    :param data: the JSON ready data, as for OutputResults
+    :var output_file_name : database to write, replaced if it exists
+    """
+    import sqlite3
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(output_file_name + suffix):
+            os.remove(output_file_name + suffix)
+    # autocommit, InsertRows makes the transactions
+    connection = sqlite3.connect(output_file_name, isolation_level=None)
+    try:
+        connection.execute("PRAGMA journal_mode=WAL")
+        # with WAL, NORMAL only risks the last transactions on power loss, never corruption
+        connection.execute("PRAGMA synchronous=NORMAL")
+        connection.execute("CREATE TABLE entries (position INTEGER PRIMARY KEY, last TEXT, first TEXT, "
+                           "color TEXT, phone TEXT, zip TEXT)")
+        # record is a number, or "<file>:<number>" in batch mode
+        connection.execute("CREATE TABLE errors (record, error TEXT, line TEXT)")
+        InsertRows(connection, "INSERT INTO entries (last, first, color, phone, zip) VALUES (?, ?, ?, ?, ?)",
+                   ((record.last, record.first, record.color, record.phone, record.zip)
+                    for record in data["entries"]))
+        error_details = dict((detail.record, detail) for detail in data.get("error_details", ()))
+        InsertRows(connection, "INSERT INTO errors (record, error, line) VALUES (?, ?, ?)",
+                   (ErrorRow(record, error_details) for record in data["errors"]))
+        connection.execute("CREATE INDEX entries_name ON entries (last, first)")
+        connection.execute("CREATE INDEX errors_record ON errors (record)")
+    finally:
+        connection.close()
+
+
+def LookupEntries(name, prefix=False):
+    """ finds entries in an indexed result without reading the rest of it. the index gives the
+        last sampled entry before name, so at most index_block entries are read past
+    :param name: "last, first" to look for
+    :param prefix: True finds every entry whose "last, first" starts with name, eg a last name
+    :var output_file_name (global): the result file, indexed by <output_file_name>.idx
+    :returns : list of matching entry dicts, in output order
+    """
+    import json
+    if isinstance(name, unicode):
+        name = name.encode("utf-8")
+    start = EntryIndex(output_file_name + ".idx", output_file_name).Find(name)
+    matches = []
+    if start is None:
+        return matches
+    with open(output_file_name, 'rb') as output_file:
+        output_file.seek(start)
+        # the rest of the line the separator is on
+        output_file.readline()
+        lines = []
+        for line in output_file:
+            lines.append(line)
+            # entries are written with the fixed layout of entry_template, which ends each with
+            # "    }" and then ", " unless it was the last
+            if not line.startswith("    }"):
+                continue
+            entry = json.loads("".join(lines).rstrip().rstrip(","))
+            lines = []
+            key = (entry["last"] + ", " + entry["first"]).encode("utf-8")
+            if key == name or (prefix and key.startswith(name)):
+                matches.append(entry)
+            elif key > name:
+                break
+            if not line.rstrip().endswith(","):
+                break
+    return matches
 
 
 def ValidateFile():
-    """ validates output to canonical file
+    """ validates output to canonical file. OutputResults has already compared everything it wrote
     :var canonical_output_file : file name to compare with
+    :var canonical_check : the check OutputResults wrote through
     """
     if test_mode:
-        if not filecmp.cmp('result.out', canonical_output_file):
-            sys.stderr.write("error - canonical test output failed\n")
-            sys.exit(4)
+        if canonical_check is None:
+            # -t with console input has no canonical file to compare with
+            print "Validation skipped, no canonical file"
+            return
+        try:
+            canonical_check.Finish()
+        except ECanonicalMismatch as e:
+            sys.stderr.write(e.message)
+            sys.exit(e.number)
         print "Validation OK. %s == %s" % (data_file_name, canonical_output_file)
 
 
 def percolate_main():
-    print "Main start"
-    time.sleep(0.001)   # otherwise argument exceptions showed up on the same line during testing
+    # stdout is the data stream in --stream & --lookup modes, keep it clean
+    streaming = "--stream" in sys.argv or "--lookup" in sys.argv
+    if not streaming:
+        print "Main start"
+        # otherwise argument exceptions can show up on the same line
+        sys.stdout.flush()
     try:
         ProcessArgs(sys.argv)
     except ENone:
@@ -383,22 +2206,65 @@ def percolate_main():
     except ERootException as e:
         sys.stderr.write(e.message)
         sys.exit(e.number)
+    if lookup_name is not None:
+        import json
+        try:
+            for entry in LookupEntries(lookup_name, lookup_prefix):
+                print json.dumps(entry, sort_keys=True)
+        except ERootException as e:
+            sys.stderr.write(e.message)
+            sys.exit(e.number)
+        return
+    if streaming:
+        StreamResults()
+        return
+    if data_file_names:
+        started = time.time()
+        data = BuildBatch()
+        RecordStage("BuildBatch", started)
+        if data is None:
+            ReportStats()
+            print "Main complete"
+            return
+    else:
+        started = time.time()
+        try:
+            interim_list_of_records, list_of_errors, list_of_error_details = BuildRecordList()
+        except ENone:
+            pass
+        RecordStage("BuildRecordList", started)
+        started = time.time()
+        try:
+            data = SortAndFinalize(interim_list_of_records, list_of_errors, list_of_error_details)
+        except ENone:
+            pass
+        RecordStage("SortAndFinalize", started)
+    started = time.time()
     try:
-        interim_list_of_records, list_of_errors, list_of_error_details = BuildRecordList()
-    except ENone:
-        pass
-    try:
-        data = SortAndFinalize(interim_list_of_records, list_of_errors, list_of_error_details)
-    except ENone:
-        pass
-    try:
-        OutputResults(data)
-    except ENone:
-        pass
+        try:
+            if output_format == "sqlite":
+                OutputSqlite(data)
+            else:
+                OutputResults(data)
+        except ENone:
+            pass
+        except ERootException as e:
+            sys.stderr.write(e.message)
+            sys.exit(e.number)
+    finally:
+        # the runs are merged as the output is written, so a -t mismatch or a failed write
+        # would leave the rest of them behind
+        RemoveRuns()
+    # entries are merged lazily, so any run merging shows up here
+    RecordStage("OutputResults", started)
+    ClearCheckpoint()
+    started = time.time()
     try:
         ValidateFile()
     except ENone:
         pass
+    RecordStage("ValidateFile", started)
+    ReportStats()
     print "Main complete"
 
 if __name__ == '__main__':
@@ -1,7 +1,19 @@
 #!/usr/bin/python
-from unittest import TestCase   #, main
+from unittest import TestCase, skipIf   #, main
+import os
 import sys
+import json
+import tempfile
+import hashlib
+import cPickle
+import StringIO
+import threading
+import sqlite3
+import gzip
+import bz2
 import PercolateTest2
+import PercolateBench
+import PercolateService
 
 
 class BagTests(TestCase):
@@ -101,6 +113,15 @@ class ProcessArgsUnitTest(TestCase):
     def test_DashVAndDataIn(self):
         self.RunOne(sys.argv[0] + " -v data.in", "[ENone(), 'data.in', None, True, False, False]")
 
+    def test_NoInputFile(self):
+        # usage, then an error. the console is never read unless asked for
+        for arglist in ([sys.argv[0]], [sys.argv[0], "--stats"]):
+            with self.assertRaises(PercolateTest2.EInvalidArguments) as raised:
+                PercolateTest2.ProcessArgs(arglist)
+            self.assertEqual(raised.exception.message, "Error: Invalid arguments: No input file specified")
+            self.assertFalse(PercolateTest2.console_io)
+        PercolateTest2.stats = None
+
 
 class FetchNextUnitTest(TestCase):
 # Traceback (most recent call last):
@@ -128,6 +149,28 @@ class FetchNextUnitTest(TestCase):
         assert result1 == canonical2, "2 expected %s, actual %s" % (result2, canonical2)
 
 
+class FetchBlocksUnitTest(TestCase):
+
+    def test_blocks_end_on_line_boundaries(self):
+        with open("canonical.in", "rb") as input_file:
+            expected = input_file.readlines()
+        saved_block_size = PercolateTest2.block_size
+        try:
+            for size in [1, 17, 100, 1024 * 1024]:
+                PercolateTest2.block_size = size
+                blocks = list(PercolateTest2.FetchBlocks("canonical.in"))
+                for block in blocks:
+                    self.assertTrue(block.endswith("\n"))
+                self.assertEqual(StringIO.StringIO("".join(blocks)).readlines(), expected)
+        finally:
+            PercolateTest2.block_size = saved_block_size
+
+    def test_range(self):
+        with open("canonical.in", "rb") as input_file:
+            expected = input_file.read()
+        self.assertEqual("".join(PercolateTest2.FetchBlocks("canonical.in", 10, 200)), expected[10:200])
+
+
 class RegexFilterUnitTest(TestCase):
 
     def test_Digits(self):
@@ -161,6 +204,702 @@ class NormalizeDataUnitTest(TestCase):
         self.assertEqual(PercolateTest2.NormalizeTheData("a,b,1234567890 "),
                          ['a', 'b', '1234567890'])
 
+class StreamWriterUnitTest(TestCase):
+
+    def WriteOne(self, data):
+        output = StringIO.StringIO()
+        PercolateTest2.StreamWriter(output).WriteDocument(data)
+        return output.getvalue()
+
+    def test_matches_json_dump(self):
+        data = {"entries": [{u"color": u"red", u"first": u"A", u"last": u"B", u"phone": u"1234567", u"zip": u"12345"}],
+                "errors": [1, 2], "error_details": [{"record": 1, "error": "nocomma", "line": "x\n"}]}
+        expected = json.dumps(data, sort_keys=True, indent=2)
+        self.assertEqual(self.WriteOne(dict((k, iter(v)) for k, v in data.items())), expected)
+
+    def test_fast_encoders_match_json(self):
+        entry = {u"color": u"red", u"first": u"Ren\xe9e \"Q\"", u"last": u"O\\Neil", u"phone": u"1234567", u"zip": u"12345"}
+        detail = {"record": 7, "error": "badzip: 1", "line": "a\tb\r\n"}
+        for encode, item in [(PercolateTest2.EncodeEntry, entry), (PercolateTest2.EncodeErrorDetail, detail)]:
+            expected = json.dumps(item, sort_keys=True, indent=2).replace("\n", "\n    ")
+            self.assertEqual(encode(item), expected)
+
+    def test_fast_encoders_decline_other_shapes(self):
+        self.assertEqual(PercolateTest2.EncodeEntry({u"color": u"red"}), None)
+        self.assertEqual(PercolateTest2.EncodeEntry({u"color": 1, u"first": u"", u"last": u"", u"phone": u"",
+                                                     u"zip": u""}), None)
+        self.assertEqual(PercolateTest2.EncodeErrorDetail({"record": "7", "error": "", "line": ""}), None)
+
+    def test_empty_lists(self):
+        data = {"entries": [], "errors": []}
+        self.assertEqual(self.WriteOne(data), json.dumps(data, sort_keys=True, indent=2))
+
+
+class RecordUnitTest(TestCase):
+
+    def test_sorts_like_key_and_dict_pairs(self):
+        records = [PercolateTest2.MakeRecord(u"Ann", u"Lee", u"12345", phone, color)
+                   for phone, color in [(u"7654321", u"red"), (u"1234567", u"red"), (u"1234567", u"blue")]]
+        pairs = [(record.key, record.AsDict()) for record in records]
+        self.assertEqual([record.AsDict() for record in sorted(records)], [pair[1] for pair in sorted(pairs)])
+
+
+class ExternalSortUnitTest(TestCase):
+
+    def test_merge_matches_in_memory_sort(self):
+        records = [PercolateTest2.MakeRecord(first, last, u"12345", u"1234567", color)
+                   for first, last, color in [(u"a", u"Z", u"red"), (u"c", u"B", u"red"), (u"q", u"M", u"red"),
+                                              (u"b", u"A", u"red"), (u"a", u"B", u"blue"), (u"a", u"B", u"red")]]
+        expected = sorted(records)
+        del PercolateTest2.sort_runs[:]
+        PercolateTest2.SpillRun(records[:2])
+        PercolateTest2.SpillRun(records[2:4])
+        data = PercolateTest2.SortAndFinalize(records[4:], [], [])
+        self.assertEqual(list(data["entries"]), expected)
+        for run_file_name in PercolateTest2.sort_runs:
+            self.assertFalse(os.path.exists(run_file_name))
+        del PercolateTest2.sort_runs[:]
+
+    def test_failed_run_removes_runs(self):
+        saved = PercolateTest2.MakeRecord, PercolateTest2.record_cost_estimate
+        made = []
+
+        def FailingMakeRecord(*fields):
+            if len(made) == 10:
+                raise ValueError("failing part way")
+            made.append(fields)
+            return saved[0](*fields)
+        PercolateTest2.MakeRecord = FailingMakeRecord
+        # a run per record
+        PercolateTest2.record_cost_estimate = 1024 * 1024 * 1024
+        PercolateTest2.max_memory = 1
+        PercolateTest2.data_file_name = "canonical.in"
+        PercolateTest2.console_io = False
+        try:
+            self.assertRaises(SystemExit, PercolateTest2.BuildRecordList)
+        finally:
+            PercolateTest2.MakeRecord, PercolateTest2.record_cost_estimate = saved
+            PercolateTest2.max_memory = None
+        self.assertEqual(PercolateTest2.sort_runs, [])
+        self.assertEqual([name for name in os.listdir(tempfile.gettempdir()) if name.endswith(".run") and
+                          name.startswith("percolate")], [])
+
+
+class CheckpointUnitTest(TestCase):
+
+    def setUp(self):
+        self.saved = (PercolateTest2.data_file_name, PercolateTest2.console_io, PercolateTest2.checkpoint_dir,
+                      PercolateTest2.checkpoint_interval, PercolateTest2.resume_mode)
+        PercolateTest2.data_file_name = "canonical.in"
+        PercolateTest2.console_io = False
+        PercolateTest2.checkpoint_dir = tempfile.mkdtemp()
+        PercolateTest2.checkpoint_interval = 10
+
+    def tearDown(self):
+        PercolateTest2.ClearCheckpoint()
+        os.rmdir(PercolateTest2.checkpoint_dir)
+        (PercolateTest2.data_file_name, PercolateTest2.console_io, PercolateTest2.checkpoint_dir,
+         PercolateTest2.checkpoint_interval, PercolateTest2.resume_mode) = self.saved
+
+    def Run(self):
+        records, errors, error_details = PercolateTest2.BuildRecordList()
+        data = PercolateTest2.SortAndFinalize(records, errors, error_details)
+        return list(data["entries"]), errors, error_details
+
+    def test_resume_matches_full_run(self):
+        PercolateTest2.resume_mode = False
+        expected = self.Run()
+        # the last checkpoint is still on disk, pick up from it
+        state = PercolateTest2.LoadCheckpointState()
+        self.assertTrue(0 < state["record_number"] < 63)
+        PercolateTest2.resume_mode = True
+        self.assertEqual(self.Run(), expected)
+
+    def test_saved_without_class_names(self):
+        # __main__.Record from the command line can't be loaded by an importer, or the other way round
+        PercolateTest2.resume_mode = False
+        self.Run()
+        state = PercolateTest2.LoadCheckpointState()
+        with open(os.path.join(PercolateTest2.checkpoint_dir, state["runs"][0]), 'rb') as run_file:
+            self.assertIs(type(cPickle.load(run_file)), tuple)
+        PercolateTest2.resume_mode = True
+        entries, errors, error_details = self.Run()
+        self.assertTrue(all(type(entry) is PercolateTest2.Record for entry in entries))
+        self.assertTrue(all(type(detail) is PercolateTest2.ErrorDetail for detail in error_details))
+
+
+class StatsUnitTest(TestCase):
+
+    def tearDown(self):
+        PercolateTest2.stats = None
+
+    def test_rule_counts(self):
+        PercolateTest2.data_file_name = "canonical.in"
+        PercolateTest2.console_io = False
+        stats = PercolateTest2.StartStats()
+        records, errors, error_details = PercolateTest2.BuildRecordList()
+        self.assertEqual(stats.lines, 64)
+        self.assertEqual(stats.rule_counts["accepted"], len(records))
+        self.assertEqual(stats.rule_counts["nocomma"],
+                         len([detail for detail in error_details if detail.error == "nocomma"]))
+        self.assertEqual(sum(stats.rule_counts.values()), 64)
+        self.assertTrue(stats.started <= stats.first_record <= PercolateTest2.time.time())
+
+    def test_hook_sees_stats(self):
+        seen = []
+        PercolateTest2.StartStats()
+        PercolateTest2.stats_hooks.append(seen.append)
+        try:
+            PercolateTest2.ReportStats()
+        finally:
+            PercolateTest2.stats_hooks.remove(seen.append)
+        self.assertEqual(seen, [PercolateTest2.stats])
+
+
+class DedupUnitTest(TestCase):
+
+    def setUp(self):
+        self.data_file_name = tempfile.mktemp()
+        with open(self.data_file_name, "w") as input_file:
+            input_file.write("Hood, Robert, (054)-813-6030, pink, 47784\n"
+                             "Robert Hood, pink, 47784, 054 813 6030\n"
+                             "Ann, Lee, 12345, 123 456 7890, red\n")
+        PercolateTest2.data_file_name = self.data_file_name
+        PercolateTest2.console_io = False
+
+    def tearDown(self):
+        os.remove(self.data_file_name)
+        PercolateTest2.dedup_mode = False
+        PercolateTest2.dedup_report = False
+
+    def test_collapse(self):
+        PercolateTest2.dedup_mode = True
+        records, errors, error_details = PercolateTest2.BuildRecordList()
+        self.assertEqual(len(records), 2)
+        self.assertEqual(errors, [])
+
+    def test_report(self):
+        PercolateTest2.dedup_mode = True
+        PercolateTest2.dedup_report = True
+        records, errors, error_details = PercolateTest2.BuildRecordList()
+        self.assertEqual(len(records), 2)
+        self.assertEqual(errors, [1])
+        self.assertEqual(error_details[0].error, "duplicate: 0")
+
+
+class NameIndexUnitTest(TestCase):
+
+    def setUp(self):
+        self.source_file_name = tempfile.mktemp()
+        self.index_file_name = tempfile.mktemp()
+        with open(self.source_file_name, "w") as source_file:
+            source_file.write("NOAH\nRIA\nQUINTON\n")
+        PercolateTest2.BuildNameIndex(self.source_file_name, self.index_file_name)
+
+    def tearDown(self):
+        os.remove(self.source_file_name)
+        os.remove(self.index_file_name)
+        PercolateTest2.name_index = None
+
+    def test_lookup(self):
+        index = PercolateTest2.NameIndex(self.index_file_name)
+        self.assertTrue(u"Noah" in index)
+        self.assertTrue("QUINTON" in index)
+        self.assertFalse(u"Moench" in index)
+        self.assertFalse(u"A Name Much Longer Than Any Slot" in index)
+        self.assertFalse(u"" in index)
+
+    def test_swaps_first_and_last(self):
+        line = "Moench, Noah, 12345, 123 456 7890, yellow\n"
+        self.assertEqual(PercolateTest2.ProcessLine(line)[1].first, u"Moench")
+        PercolateTest2.name_index = PercolateTest2.NameIndex(self.index_file_name)
+        self.assertEqual(PercolateTest2.ProcessLine(line)[1].first, u"Noah")
+
+
+class ProcessBlockUnitTest(TestCase):
+
+    @skipIf(not PercolateTest2.LoadNumpy(), "numpy is not installed")
+    def test_matches_scalar_engine(self):
+        with open("data.in") as input_file:
+            raw_lines = input_file.readlines()
+        raw_lines.append("Ann, Lee, 12345, 123 456 7890, chartreuse\n")
+        expected = [PercolateTest2.ProcessLine(raw_line) for raw_line in raw_lines]
+        self.assertEqual(PercolateTest2.ProcessBlock(raw_lines), expected)
+
+
+class StreamResultsUnitTest(TestCase):
+
+    def test_one_json_line_per_input_line(self):
+        PercolateTest2.data_file_name = "canonical.in"
+        PercolateTest2.console_io = False
+        output = StringIO.StringIO()
+        PercolateTest2.StreamResults(output)
+        lines = [json.loads(line) for line in output.getvalue().splitlines()]
+        self.assertEqual(len(lines), 64)
+        self.assertEqual(lines[0]["record"], 0)
+        self.assertEqual(lines[0]["error"], "badzip: 123123121")
+        self.assertEqual(lines[1]["last"], "Tillotson")
+
+
+class RejectLogUnitTest(TestCase):
+
+    def setUp(self):
+        PercolateTest2.data_file_name = "canonical.in"
+        PercolateTest2.console_io = False
+        PercolateTest2.reject_log_file_name = tempfile.mktemp()
+
+    def tearDown(self):
+        os.remove(PercolateTest2.reject_log_file_name)
+        PercolateTest2.reject_log_file_name = None
+        PercolateTest2.max_error_details = None
+
+    def test_rejects_streamed_and_details_capped(self):
+        PercolateTest2.max_error_details = 2
+        records, errors, error_details = PercolateTest2.BuildRecordList()
+        self.assertEqual(len(error_details), 2)
+        with open(PercolateTest2.reject_log_file_name) as reject_log:
+            rejects = [json.loads(line) for line in reject_log]
+        self.assertEqual([reject["record"] for reject in rejects], errors)
+        self.assertEqual(rejects[0], error_details[0].AsDict())
+
+
+class CanonicalCheckUnitTest(TestCase):
+
+    def setUp(self):
+        self.canonical_file_name = tempfile.mktemp()
+        with open(self.canonical_file_name, "wb") as canonical_file:
+            canonical_file.write("line one\nline two\n")
+
+    def tearDown(self):
+        os.remove(self.canonical_file_name)
+
+    def test_match(self):
+        check = PercolateTest2.CanonicalCheck(self.canonical_file_name)
+        check.write("line o")
+        check.write("ne\nline two\n")
+        check.Finish()
+
+    def test_first_divergent_line_reported(self):
+        check = PercolateTest2.CanonicalCheck(self.canonical_file_name)
+        check.write("line one\n")
+        with self.assertRaises(PercolateTest2.ECanonicalMismatch) as raised:
+            check.write("line 2")
+        self.assertEqual(raised.exception.d.offset, 14)
+        self.assertEqual(raised.exception.d.expected, "line two")
+        self.assertEqual(raised.exception.d.actual, "line 2")
+        self.assertEqual(raised.exception.number, 4)
+        # a count mismatch diverges at a line break, both versions still show
+        for canonical, output, expected, actual in (("    1, \n    2\n  ]\n}", ", \n    3\n  ]\n}", "  ]", "    2, "),
+                                                    ("    1, \n    2, \n    3\n  ]\n}", "\n  ]\n}", "    2, ", "  ]")):
+            with open(self.canonical_file_name, "wb") as canonical_file:
+                canonical_file.write(canonical)
+            check = PercolateTest2.CanonicalCheck(self.canonical_file_name)
+            check.write("    1, \n    2")
+            with self.assertRaises(PercolateTest2.ECanonicalMismatch) as raised:
+                check.write(output)
+            self.assertEqual(raised.exception.d.offset, 13)
+            self.assertEqual(raised.exception.d.expected, expected)
+            self.assertEqual(raised.exception.d.actual, actual)
+
+    def test_no_canonical_file(self):
+        # -t with console input writes the output unchecked
+        saved = PercolateTest2.test_mode, PercolateTest2.canonical_output_file, PercolateTest2.output_file_name
+        PercolateTest2.test_mode = True
+        PercolateTest2.canonical_output_file = None
+        PercolateTest2.output_file_name = self.canonical_file_name + ".out"
+        try:
+            PercolateTest2.OutputResults({"entries": [], "errors": []})
+            PercolateTest2.ValidateFile()
+            self.assertTrue(os.path.isfile(PercolateTest2.output_file_name))
+        finally:
+            os.remove(PercolateTest2.output_file_name)
+            PercolateTest2.test_mode, PercolateTest2.canonical_output_file, PercolateTest2.output_file_name = saved
+
+    def test_short_output(self):
+        check = PercolateTest2.CanonicalCheck(self.canonical_file_name)
+        check.write("line one\n")
+        self.assertRaises(PercolateTest2.ECanonicalMismatch, check.Finish)
+
+    def test_digest_manifest(self):
+        manifest_file_name = tempfile.mktemp()
+        with open(manifest_file_name, "w") as manifest:
+            manifest.write(hashlib.sha1("line one\nline two\n").hexdigest() + "  canonical.out\n")
+        try:
+            check = PercolateTest2.DigestCheck(manifest_file_name)
+            check.write("line one\nline two\n")
+            check.Finish()
+            check.write("more")
+            self.assertRaises(PercolateTest2.ECanonicalMismatch, check.Finish)
+        finally:
+            os.remove(manifest_file_name)
+
+
+class ServiceUnitTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.work_dir, "percolate.sock")
+        self.server = PercolateService.ForkingUnixServer(self.socket_path, PercolateService.JobHandler)
+
+    def tearDown(self):
+        self.server.server_close()
+        for file_name in os.listdir(self.work_dir):
+            os.remove(os.path.join(self.work_dir, file_name))
+        os.rmdir(self.work_dir)
+
+    def Send(self, args):
+        """ runs one --inline job of canonical.in through the server, returns the reply """
+        with open("canonical.in") as input_file:
+            self.server.socket.listen(1)
+            reply = [None]
+            client = threading.Thread(target=lambda: reply.__setitem__(0, PercolateService.SendJob(
+                self.socket_path, args, input_file, inline=True, cwd=self.work_dir)))
+            client.start()
+            self.server.handle_request()
+            client.join()
+        return reply[0]
+
+    def test_job_matches_command_line_run(self):
+        reply = self.Send([])
+        self.assertEqual(reply["returncode"], 0)
+        self.assertEqual(reply["output"], os.path.join(self.work_dir, "result.out"))
+        result = json.loads(reply["result"])
+        with open("canonical.out") as canonical:
+            expected = json.load(canonical)
+        self.assertEqual(result["entries"], expected["entries"])
+        self.assertEqual(result["errors"], expected["errors"])
+
+    def test_gzip_output_inline(self):
+        reply = self.Send(["--output", "result.out.gz"])
+        self.assertEqual(reply["returncode"], 0)
+        with open("canonical.out") as canonical:
+            self.assertEqual(json.loads(reply["result"])["entries"], json.load(canonical)["entries"])
+
+
+class BatchUnitTest(TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        with open("canonical.in") as canonical:
+            lines = canonical.readlines()
+        for name, part in (("a.in", lines[:30]), ("b.in", lines[30:])):
+            with open(os.path.join(self.work_dir, name), 'w') as input_file:
+                input_file.writelines(part)
+
+    def tearDown(self):
+        for file_name in os.listdir(self.work_dir):
+            os.remove(os.path.join(self.work_dir, file_name))
+        os.rmdir(self.work_dir)
+        PercolateTest2.data_file_names = []
+        PercolateTest2.per_file_mode = False
+        PercolateTest2.output_file_name = "result.out"
+
+    def test_directory_and_glob_expand_sorted(self):
+        expected = [os.path.join(self.work_dir, "a.in"), os.path.join(self.work_dir, "b.in")]
+        self.assertEqual(PercolateTest2.ExpandInputs([self.work_dir]), expected)
+        self.assertEqual(PercolateTest2.ExpandInputs([os.path.join(self.work_dir, "*.in")]), expected)
+        self.assertRaises(PercolateTest2.EFileNotFound, PercolateTest2.ExpandInputs,
+                          [os.path.join(self.work_dir, "*.none")])
+
+    def test_merged_matches_single_file(self):
+        PercolateTest2.console_io = False
+        PercolateTest2.verbose_mode = False
+        PercolateTest2.data_file_name = "canonical.in"
+        records, errors, error_details = PercolateTest2.BuildRecordList()
+        PercolateTest2.data_file_names = PercolateTest2.ExpandInputs([self.work_dir])
+        data = PercolateTest2.BuildBatch()
+        self.assertEqual(list(data["entries"]), sorted(records))
+        a_name = os.path.join(self.work_dir, "a.in")
+        self.assertEqual(data["errors"][0], a_name + ":0")
+        self.assertEqual(len(data["errors"]), len(errors))
+
+    def test_stats_merged_from_workers(self):
+        PercolateTest2.verbose_mode = False
+        PercolateTest2.data_file_names = PercolateTest2.ExpandInputs([self.work_dir])
+        stats = PercolateTest2.StartStats()
+        try:
+            data = PercolateTest2.BuildBatch()
+        finally:
+            PercolateTest2.stats = None
+        self.assertEqual(stats.lines, 64)
+        self.assertEqual(stats.rule_counts["accepted"], len(list(data["entries"])))
+        self.assertEqual(sum(stats.rule_counts.values()), 64)
+
+    def test_per_file_outputs(self):
+        PercolateTest2.per_file_mode = True
+        PercolateTest2.output_file_name = self.work_dir
+        PercolateTest2.data_file_names = PercolateTest2.ExpandInputs([self.work_dir])
+        self.assertEqual(PercolateTest2.BuildBatch(), None)
+        with open(os.path.join(self.work_dir, "b.result.out")) as output_file:
+            self.assertEqual(len(json.load(output_file)["entries"]), 22)
+
+
+class WorkerOptionsUnitTest(TestCase):
+
+    def test_options_reach_a_fresh_worker(self):
+        saved = PercolateTest2.WorkerOptions()
+        try:
+            PercolateTest2.valid_colors = PercolateTest2.BuildColorIndex([["mauve", "lilac"]])
+            PercolateTest2.canonical_colors = True
+            PercolateTest2.output_file_name = "somewhere"
+            # the snapshot is pickled on its way to spawned workers
+            options = cPickle.loads(cPickle.dumps(PercolateTest2.WorkerOptions()))
+            PercolateTest2.StartWorker(saved)
+            PercolateTest2.StartWorker(options)
+            self.assertEqual(PercolateTest2.valid_colors, {u"mauve": u"mauve", u"lilac": u"mauve"})
+            self.assertTrue(PercolateTest2.canonical_colors)
+            self.assertEqual(PercolateTest2.output_file_name, "somewhere")
+            self.assertIsNone(PercolateTest2.stats)
+        finally:
+            PercolateTest2.StartWorker(saved)
+
+
+class LimitUnitTest(TestCase):
+
+    def setUp(self):
+        PercolateTest2.data_file_name = "canonical.in"
+        PercolateTest2.console_io = False
+        PercolateTest2.verbose_mode = False
+
+    def tearDown(self):
+        PercolateTest2.output_offset = 0
+        PercolateTest2.output_limit = None
+
+    def test_slice_matches_full_run(self):
+        records, errors, error_details = PercolateTest2.BuildRecordList()
+        expected = sorted(records)[3:8]
+        PercolateTest2.output_offset = 3
+        PercolateTest2.output_limit = 5
+        records, errors, error_details = PercolateTest2.BuildRecordList()
+        self.assertTrue(len(records) < 2 * 8)
+        data = PercolateTest2.SortAndFinalize(records, errors, error_details)
+        self.assertEqual(data["entries"], expected)
+        output = StringIO.StringIO()
+        PercolateTest2.StreamWriter(output).WriteDocument(data)
+        self.assertEqual(output.getvalue(), json.dumps({"entries": [record.AsDict() for record in expected],
+                                                        "errors": errors}, sort_keys=True, indent=2))
+
+
+class EntryIndexUnitTest(TestCase):
+
+    def setUp(self):
+        PercolateTest2.data_file_name = "canonical.in"
+        PercolateTest2.console_io = False
+        PercolateTest2.verbose_mode = False
+        PercolateTest2.test_mode = False
+        PercolateTest2.index_mode = True
+        PercolateTest2.index_block = 4
+        PercolateTest2.output_file_name = tempfile.mktemp()
+        records, errors, error_details = PercolateTest2.BuildRecordList()
+        PercolateTest2.OutputResults(PercolateTest2.SortAndFinalize(records, errors, error_details))
+        with open(PercolateTest2.output_file_name) as output_file:
+            self.entries = json.load(output_file)["entries"]
+
+    def tearDown(self):
+        os.remove(PercolateTest2.output_file_name)
+        os.remove(PercolateTest2.output_file_name + ".idx")
+        PercolateTest2.index_mode = False
+        PercolateTest2.index_block = 64
+        PercolateTest2.output_file_name = "result.out"
+
+    def test_exact_and_prefix(self):
+        for entry in self.entries:
+            name = entry["last"] + ", " + entry["first"]
+            expected = [other for other in self.entries if other["last"] + ", " + other["first"] == name]
+            self.assertEqual(PercolateTest2.LookupEntries(name), expected)
+        last = self.entries[20]["last"]
+        self.assertEqual(PercolateTest2.LookupEntries(last, prefix=True),
+                         [entry for entry in self.entries if entry["last"].startswith(last)])
+        self.assertEqual(PercolateTest2.LookupEntries("Zz, Nobody"), [])
+
+    def test_stale_index_refused(self):
+        with open(PercolateTest2.output_file_name, 'a') as output_file:
+            output_file.write("\n")
+        self.assertRaises(PercolateTest2.EInvalidArguments, PercolateTest2.LookupEntries, "Moench, Noah")
+
+
+class SqliteUnitTest(TestCase):
+
+    def setUp(self):
+        PercolateTest2.data_file_name = "canonical.in"
+        PercolateTest2.console_io = False
+        PercolateTest2.verbose_mode = True
+        PercolateTest2.output_file_name = tempfile.mktemp()
+
+    def tearDown(self):
+        os.remove(PercolateTest2.output_file_name)
+        PercolateTest2.output_file_name = "result.out"
+        PercolateTest2.sqlite_batch = 500000
+
+    def test_tables_match_json(self):
+        # several transactions
+        PercolateTest2.sqlite_batch = 7
+        records, errors, error_details = PercolateTest2.BuildRecordList()
+        PercolateTest2.OutputSqlite(PercolateTest2.SortAndFinalize(records, errors, error_details))
+        connection = sqlite3.connect(PercolateTest2.output_file_name)
+        rows = connection.execute("SELECT last, first, color, phone, zip FROM entries ORDER BY position").fetchall()
+        self.assertEqual(rows, [(record.last, record.first, record.color, record.phone, record.zip)
+                                for record in sorted(records)])
+        rows = connection.execute("SELECT record, error, line FROM errors ORDER BY rowid").fetchall()
+        self.assertEqual(rows, [tuple(detail) for detail in error_details])
+        connection.close()
+
+
+class CompressedInputUnitTest(TestCase):
+
+    def setUp(self):
+        with open("canonical.in", 'rb') as canonical:
+            self.plain = canonical.read()
+        self.file_name = tempfile.mktemp()
+
+    def tearDown(self):
+        os.remove(self.file_name)
+        PercolateTest2.block_size = 1024 * 1024
+
+    def test_gzip_and_bzip2_streams_read_through(self):
+        # small blocks, so lines & streams straddle reads
+        PercolateTest2.block_size = 100
+        for compress in (gzip.open, lambda file_name, mode: bz2.BZ2File(file_name, mode)):
+            with open(self.file_name, 'wb') as output:
+                for copy in range(2):
+                    with compress(self.file_name + ".part", 'wb') as part:
+                        part.write(self.plain)
+                    with open(self.file_name + ".part", 'rb') as part:
+                        output.write(part.read())
+            os.remove(self.file_name + ".part")
+            blocks = list(PercolateTest2.FetchBlocks(self.file_name))
+            self.assertEqual("".join(blocks), self.plain * 2)
+            self.assertTrue(all(block.endswith("\n") for block in blocks))
+
+    def test_start_skips_decompressed_bytes(self):
+        with gzip.open(self.file_name, 'wb') as output:
+            output.write(self.plain)
+        start = self.plain.index("\n") + 1
+        self.assertEqual("".join(PercolateTest2.FetchBlocks(self.file_name, start)), self.plain[start:])
+
+    def test_truncated_input_raises(self):
+        PercolateTest2.block_size = 100
+        for compress in (gzip.open, lambda file_name, mode: bz2.BZ2File(file_name, mode)):
+            with compress(self.file_name, 'wb') as output:
+                output.write(self.plain)
+            with open(self.file_name, 'rb') as input_file:
+                compressed = input_file.read()
+            # cut inside the data, and inside the end of stream marker
+            for size in (len(compressed) / 2, len(compressed) - 3):
+                with open(self.file_name, 'wb') as output:
+                    output.write(compressed[:size])
+                self.assertRaises(IOError, list, PercolateTest2.FetchBlocks(self.file_name))
+
+
+class EncodingUnitTest(TestCase):
+
+    def tearDown(self):
+        PercolateTest2.input_encoding = "utf-8"
+
+    def test_accepted_fields_are_text(self):
+        error, record = PercolateTest2.ProcessLine("Booker T., Washington, 87360, 373 781 7380, yellow\n")
+        self.assertIsNone(error)
+        self.assertTrue(all(isinstance(field, unicode) for field in record))
+
+    def test_non_ascii_line_is_rejected_and_decoded(self):
+        raw_line = "Ren\xe9e, Smith, 8736, 373 781 7380, yellow"
+        error, record = PercolateTest2.ProcessLine(raw_line + "\n")
+        self.assertIsNone(record)
+        PercolateTest2.input_encoding = "latin-1"
+        self.assertEqual(PercolateTest2.ErrorDetail(1, error, raw_line).AsDict()["line"],
+                         u"Ren\xe9e, Smith, 8736, 373 781 7380, yellow")
+        PercolateTest2.input_encoding = "utf-8"
+        self.assertIn(u"\ufffd", PercolateTest2.ErrorDetail(1, error, raw_line).AsDict()["line"])
+
+    def test_encoding_must_be_ascii_compatible(self):
+        self.assertRaises(PercolateTest2.EInvalidArguments, PercolateTest2.ProcessArgs,
+                          ["canonical.in", "--encoding", "utf-16"])
+
+
+class SplitChunksUnitTest(TestCase):
+
+    def test_chunks_cover_file_on_line_boundaries(self):
+        with open("canonical.in", "rb") as input_file:
+            lines = input_file.readlines()
+        results = []
+        for chunk in PercolateTest2.SplitChunks("canonical.in", 7):
+            results.extend(PercolateTest2.ProcessChunk(chunk))
+        self.assertEqual(len(results), len(lines))
+        for line, result in zip(lines, results):
+            self.assertEqual(result[:2], PercolateTest2.ProcessLine(line))
+
+
+class MatchLayoutUnitTest(TestCase):
+
+    def test_agrees_with_full_rules(self):
+        matched = 0
+        with open("canonical.in") as input_file:
+            for raw_line in input_file:
+                line = unicode(raw_line.strip())
+                fields = PercolateTest2.MatchLayout(line)
+                if fields is None:
+                    continue
+                matched += 1
+                error, expected = PercolateTest2.ClassifyFields(line)
+                self.assertEqual(error, None)
+                phone = expected[3].replace(" ", "").replace("-", "")
+                self.assertEqual(fields, expected[:3] + (phone, expected[4]))
+        self.assertTrue(matched > 0)
+
+    def test_unclean_line_falls_back(self):
+        self.assertEqual(PercolateTest2.MatchLayout(u"Smith , Bob, 12345, 123 456 7890, red"), None)
+        self.assertEqual(PercolateTest2.MatchLayout(u"0.547777482345"), None)
+
+
+class ColorIndexUnitTest(TestCase):
+
+    def test_aliases_map_to_canonical(self):
+        self.assertEqual(PercolateTest2.valid_colors[u"grey"], u"gray")
+        self.assertEqual(PercolateTest2.valid_colors[u"aqua marine"], u"aquamarine")
+
+    def test_fragments_rejected(self):
+        for fragment in [u"ee", u"magentacerise", u"peach cobalt", u"pink, blue"]:
+            self.assertFalse(fragment in PercolateTest2.valid_colors, fragment)
+
+    def test_LoadColors(self):
+        color_file_name = tempfile.mktemp()
+        with open(color_file_name, "w") as color_file:
+            color_file.write("# test colors\n\nchartreuse\ngray, grey\n")
+        try:
+            index = PercolateTest2.LoadColors(color_file_name)
+        finally:
+            os.remove(color_file_name)
+        self.assertEqual(index, {u"chartreuse": u"chartreuse", u"gray": u"gray", u"grey": u"gray"})
+
+
+class GenerateRolodexUnitTest(TestCase):
+
+    def test_generated_lines_parse(self):
+        data_file_name = tempfile.mktemp()
+        try:
+            PercolateBench.GenerateRolodex(data_file_name, 2000, reject_rate=0.25, seed=1)
+            with open(data_file_name) as input_file:
+                results = [PercolateTest2.ProcessLine(line) for line in input_file]
+        finally:
+            os.remove(data_file_name)
+        self.assertEqual(len(results), 2000)
+        rejects = len([error for error, new_record in results if error])
+        self.assertTrue(400 < rejects < 600, rejects)
+
+    def test_startup_over_budget_fails(self):
+        results_file_name = tempfile.mktemp()
+        saved_argv = sys.argv
+        sys.argv = ["PercolateBench.py", "--startup", "--count", "1", "--budget", "0.001",
+                    "--output", results_file_name]
+        try:
+            self.assertRaises(SystemExit, PercolateBench.bench_main)
+            with open(results_file_name) as results_file:
+                self.assertEqual(json.load(results_file)["startup"]["budget"], 0.000001)
+        finally:
+            sys.argv = saved_argv
+            os.remove(results_file_name)
+
+
 # print __name__
 # if __name__ == '__main__':
 #     unittest.main()